@@ -0,0 +1,105 @@
+"""
+Авторизация Mini App.
+
+POST /api/auth/webapp один раз проверяет подпись initData Telegram
+(HMAC-SHA256 с ключом от BOT_TOKEN) и выдаёт короткоживущий токен
+«payload.signature»: в payload — id, код, ФИО, is_active и version
+представителя. Дальше заявка проверяет токен в памяти; изменение или
+деактивация представителя увеличивает version и отзывает выданные токены.
+
+WEBAPP_AUTH_REQUIRED=1 — заявки без токена не принимаются (иначе для
+старых клиентов остаётся проверка по telegram_id).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import parse_qsl
+from fastapi import HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import rep_cache
+from db.rep_cache import RepInfo
+
+BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+SESSION_TTL = int(os.getenv("WEBAPP_SESSION_TTL", "3600"))
+INIT_DATA_MAX_AGE = int(os.getenv("WEBAPP_INIT_DATA_MAX_AGE", "86400"))
+AUTH_REQUIRED = os.getenv("WEBAPP_AUTH_REQUIRED", "0") in ("1", "true", "yes")
+
+# Один секрет на все воркеры: задан явно или выводится из токена бота
+_secret = (os.getenv("SESSION_SECRET") or "").encode() or hmac.new(
+    BOT_TOKEN.encode(), b"webapp-session", hashlib.sha256).digest()
+
+
+def verify_init_data(init_data: str) -> Optional[dict]:
+    """Пользователь Telegram из initData или None, если подпись неверна или данные устарели"""
+    params = dict(parse_qsl(init_data, keep_blank_values=True))
+    received = params.pop("hash", "")
+    if not received or not BOT_TOKEN:
+        return None
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        return None
+    try:
+        if time.time() - int(params.get("auth_date", 0)) > INIT_DATA_MAX_AGE:
+            return None
+        return json.loads(params["user"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_secret, payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(rep: RepInfo) -> tuple[str, int]:
+    """Токен и время истечения (unix)"""
+    expires_at = int(time.time()) + SESSION_TTL
+    payload = _b64encode(json.dumps({
+        "rid": rep.id, "tid": rep.telegram_id, "code": rep.code, "name": rep.full_name,
+        "act": rep.is_active, "ver": rep.version, "exp": expires_at,
+    }, ensure_ascii=False, separators=(",", ":")).encode())
+    return f"{payload}.{_sign(payload)}", expires_at
+
+
+def read_token(token: str) -> Optional[RepInfo]:
+    """RepInfo из токена или None — подделан или истёк"""
+    payload, _, signature = token.partition(".")
+    if not signature or not hmac.compare_digest(_sign(payload), signature):
+        return None
+    try:
+        data = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if data.get("exp", 0) < time.time():
+        return None
+    return RepInfo(data["rid"], data["code"], data["tid"], data["name"], data["act"], data["ver"])
+
+
+async def rep_from_request(request: Request, db: AsyncSession) -> Optional[RepInfo]:
+    """
+    Представитель по заголовку Authorization: Bearer <токен>.
+    None — токена нет и он не обязателен; 401 — токен недействителен.
+    """
+    header = request.headers.get("authorization", "")
+    if not header.lower().startswith("bearer "):
+        if AUTH_REQUIRED:
+            raise HTTPException(401, "Нужна авторизация через Telegram")
+        return None
+    rep = read_token(header[7:].strip())
+    if rep is None or not await rep_cache.is_current(db, rep.id, rep.version):
+        raise HTTPException(401, "Сессия истекла — откройте приложение заново")
+    return rep
@@ -0,0 +1,140 @@
+"""
+Потоковая выгрузка заявок в CSV и XLSX.
+
+Строки приходят пачками из серверного курсора и сразу уходят клиенту —
+память не зависит от объёма истории. XLSX собирается вручную (zip +
+SpreadsheetML с inline-строками), без сторонних библиотек.
+"""
+import csv
+import io
+import zipfile
+from datetime import datetime
+from typing import AsyncIterator, Iterable
+from xml.sax.saxutils import escape
+
+HEADERS = [
+    "ID заявки", "Дата", "Код", "Медпредставитель", "Username", "Учреждение", "Статус",
+    "Препарат", "Кол-во", "Ед.", "Цена", "Сумма позиции",
+    "Сумма заявки", "Оплата %", "К оплате",
+]
+
+
+def _cells(row) -> list:
+    (order_id, created_at, rep_code, full_name, username, institution, status,
+     total_price, payment_percent, payment_amount,
+     product_name, quantity, unit, price, line_total) = row
+    return [
+        order_id,
+        created_at.strftime("%d.%m.%Y %H:%M") if isinstance(created_at, datetime) else created_at,
+        rep_code or "",
+        full_name,
+        f"@{username}" if username else "",
+        institution,
+        status,
+        product_name or "",
+        quantity,
+        unit or "",
+        price,
+        line_total,
+        total_price,
+        payment_percent,
+        payment_amount,
+    ]
+
+
+# ─── CSV ─────────────────────────────────────────────────────
+
+async def csv_stream(batches: AsyncIterator[Iterable]) -> AsyncIterator[bytes]:
+    """CSV с BOM и разделителем «;» — так его без вопросов открывает русский Excel"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow(HEADERS)
+    yield ("\ufeff" + buffer.getvalue()).encode()
+    async for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_cells(row) for row in batch)
+        yield buffer.getvalue().encode()
+
+
+# ─── XLSX ────────────────────────────────────────────────────
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>"""
+
+_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Заявки" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>"""
+
+_SHEET_START = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+_SHEET_END = "</sheetData></worksheet>"
+
+
+class _Sink(io.RawIOBase):
+    """Несикаемый поток: zipfile пишет сюда, а мы забираем готовые байты"""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _xlsx_row(values: list) -> str:
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append("<c/>")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f"<c><v>{value}</v></c>")
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+
+async def xlsx_stream(batches: AsyncIterator[Iterable]) -> AsyncIterator[bytes]:
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        archive.writestr("_rels/.rels", _ROOT_RELS)
+        archive.writestr("xl/workbook.xml", _WORKBOOK)
+        archive.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((_SHEET_START + _xlsx_row(HEADERS)).encode())
+            yield sink.take()
+            async for batch in batches:
+                sheet.write("".join(_xlsx_row(_cells(row)) for row in batch).encode())
+                yield sink.take()
+            sheet.write(_SHEET_END.encode())
+    yield sink.take()
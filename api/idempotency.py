@@ -0,0 +1,146 @@
+"""
+Идемпотентная отправка заявок.
+
+Ключ приходит в заголовке Idempotency-Key (Mini App выдаёт новый на
+каждую заявку); без заголовка заявка выполняется как есть — выводить ключ
+из содержимого нельзя, иначе намеренный повтор той же заявки молча вернул
+бы первый ответ. Одновременные запросы
+с одним ключом в процессе склеиваются в одно выполнение; между
+процессами и после рестарта — через таблицу idempotency_keys, где
+сохранённый ответ живёт IDEMPOTENCY_TTL_HOURS часов. С ключом хранится
+хеш тела заявки: тот же ключ с другим телом отклоняется (422).
+
+Выполняющийся запрос держит ключ в аренде и продлевает её каждые
+LEASE_RENEW секунд, сколько бы ни ждал пула БД или блокировок. Ключ
+занимается заново, только если продлений не было LEASE_TIMEOUT секунд
+(процесс упал), а заказ фиксируется лишь вместе с ответом по ключу
+(complete) — при перехваченной аренде он откатывается.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+from fastapi import HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import AsyncSessionLocal
+from db import crud
+
+logger = logging.getLogger(__name__)
+
+TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+PURGE_INTERVAL = 3600
+LEASE_TIMEOUT = 60
+LEASE_RENEW = 15
+
+_owners: dict[str, str] = {}        # ключ → токен аренды выполняющегося здесь запроса
+_inflight: dict[str, tuple[str, asyncio.Future]] = {}     # ключ → (хеш тела, результат)
+_last_purge = 0.0
+
+
+def payload_hash(payload: dict) -> str:
+    body = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def key_for(request: Request, telegram_id: int) -> Optional[str]:
+    """Ключ из заголовка Idempotency-Key; None — заголовка нет, заявка без защиты от повтора"""
+    client_key = request.headers.get("idempotency-key", "").strip()[:100]
+    if not client_key:
+        return None
+    return f"{telegram_id}:{client_key}"
+
+
+def _mismatch() -> HTTPException:
+    return HTTPException(422, "Ключ Idempotency-Key уже использован для другой заявки")
+
+
+async def _purge_if_due():
+    global _last_purge
+    if time.monotonic() - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = time.monotonic()
+    async with AsyncSessionLocal() as db:
+        await crud.purge_idempotency_keys(db, datetime.utcnow() - timedelta(hours=TTL_HOURS))
+
+
+def busy() -> HTTPException:
+    return HTTPException(409, "Эта заявка уже обрабатывается, подождите несколько секунд")
+
+
+async def complete(db: AsyncSession, key: str, response: dict) -> bool:
+    """
+    Сохранить ответ по ключу в транзакции заказа (без commit).
+    False — аренду ключа перехватили: заказ нужно откатить.
+    """
+    owner = _owners.get(key)
+    return owner is not None and await crud.complete_idempotency_key(db, key, owner, response)
+
+
+async def _renew(key: str, owner: str):
+    while True:
+        await asyncio.sleep(LEASE_RENEW)
+        try:
+            async with AsyncSessionLocal() as db:
+                if not await crud.renew_idempotency_key(db, key, owner):
+                    return
+        except Exception:
+            logger.exception("Не удалось продлить аренду ключа %s", key)
+
+
+async def _execute(key: str, digest: str, action: Callable[[str], Awaitable[dict]]) -> dict:
+    owner = uuid.uuid4().hex
+    async with AsyncSessionLocal() as db:
+        existing = await crud.claim_idempotency_key(db, key, digest, owner, stale_after=LEASE_TIMEOUT)
+    if existing is not None:
+        if existing.payload_hash and existing.payload_hash != digest:
+            raise _mismatch()
+        if existing.status == "done":
+            return {**json.loads(existing.response_json), "replayed": True}
+        raise busy()
+    _owners[key] = owner
+    renewal = asyncio.create_task(_renew(key, owner))
+    try:
+        # action сохраняет ответ по ключу (complete) в одной транзакции с заказом
+        return await action(key)
+    except BaseException:
+        async with AsyncSessionLocal() as db:
+            await crud.release_idempotency_key(db, key, owner)
+        raise
+    finally:
+        renewal.cancel()
+        _owners.pop(key, None)
+
+
+async def run(key: str, payload: dict, action: Callable[[str], Awaitable[dict]]) -> dict:
+    """
+    Выполнить action(key) не более одного раза для данного ключа.
+    Тот же ключ с другим payload — 422: повтор не должен выдать старую
+    заявку за успешную отправку изменённой корзины.
+    """
+    await _purge_if_due()
+    digest = payload_hash(payload)
+    inflight = _inflight.get(key)
+    if inflight is not None:
+        if inflight[0] != digest:
+            raise _mismatch()
+        return await asyncio.shield(inflight[1])
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = (digest, future)
+    try:
+        result = await _execute(key, digest, action)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()           # помечаем как прочитанное, если ждущих нет
+        raise
+    finally:
+        _inflight.pop(key, None)
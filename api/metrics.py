@@ -0,0 +1,202 @@
+"""
+Метрики в формате Prometheus (/metrics) и лог медленных запросов.
+
+- MetricsMiddleware — время запроса по шаблону роута, число и время
+  SQL-запросов внутри запроса;
+- instrument_engine — хуки before/after_cursor_execute на движке;
+- SHEETS_*, WEBHOOK_* — выгрузка в Sheets и обработка update'ов.
+"""
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Optional
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))   # 0 — лог выключен
+
+
+# ─── Примитивы ───────────────────────────────────────────────
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значение снимается в момент рендера"""
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name, self.help, self.read = name, help, read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}       # labels → [counts по бакетам, sum, count]
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels + ("le",), values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels + ("le",), values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {count}")
+        return lines
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP-запросы", ("method", "route", "status"))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "Время HTTP-запроса", LATENCY_BUCKETS, ("route",))
+HTTP_SQL_STATEMENTS = Histogram("http_request_sql_statements", "SQL-запросов на HTTP-запрос", COUNT_BUCKETS, ("route",))
+HTTP_SQL_SECONDS = Histogram("http_request_sql_seconds", "Время SQL на HTTP-запрос", LATENCY_BUCKETS, ("route",))
+SQL_STATEMENTS = Counter("sql_statements_total", "Все SQL-запросы процесса")
+SHEETS_APPEND = Histogram("sheets_append_seconds", "Время вызова append_rows в Google Sheets", LATENCY_BUCKETS)
+SHEETS_ROWS = Counter("sheets_rows_total", "Строк выгружено в Google Sheets")
+SHEETS_FAILURES = Counter("sheets_failures_total", "Неудачные выгрузки в Google Sheets")
+WEBHOOK_UPDATE = Histogram("webhook_update_seconds", "Обработка update'а Telegram", LATENCY_BUCKETS, ("result",))
+
+_registry: list = [
+    HTTP_REQUESTS, HTTP_DURATION, HTTP_SQL_STATEMENTS, HTTP_SQL_SECONDS, SQL_STATEMENTS,
+    SHEETS_APPEND, SHEETS_ROWS, SHEETS_FAILURES, WEBHOOK_UPDATE,
+]
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ─── SQL в рамках запроса ────────────────────────────────────
+
+class RequestSql:
+    __slots__ = ("count", "seconds", "queries")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries: list[tuple[float, str]] = []
+
+
+_current: ContextVar[Optional[RequestSql]] = ContextVar("request_sql", default=None)
+
+
+def instrument_engine(engine):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        SQL_STATEMENTS.inc()
+        stats = _current.get()
+        if stats is not None:
+            stats.count += 1
+            stats.seconds += elapsed
+            if SLOW_REQUEST_MS and len(stats.queries) < 50:
+                stats.queries.append((elapsed, statement))
+
+
+# ─── HTTP ────────────────────────────────────────────────────
+
+def _route_label(scope) -> str:
+    route = scope.get("route")
+    if route is not None and hasattr(route, "path"):
+        return route.path
+    return "static" if "endpoint" in scope else "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: время запроса и SQL по шаблону роута"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestSql()
+        token = _current.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - started
+            route = _route_label(scope)
+            HTTP_REQUESTS.inc(scope["method"], route, status)
+            HTTP_DURATION.observe(elapsed, route)
+            HTTP_SQL_STATEMENTS.observe(stats.count, route)
+            HTTP_SQL_SECONDS.observe(stats.seconds, route)
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                queries = "\n".join(
+                    f"  {q_elapsed * 1000:.1f} ms  {' '.join(statement.split())[:300]}"
+                    for q_elapsed, statement in sorted(stats.queries, reverse=True)[:10]
+                )
+                logger.warning(
+                    "Медленный запрос %s %s: %.0f ms, SQL: %d за %.0f ms\n%s",
+                    scope["method"], route, elapsed * 1000, stats.count, stats.seconds * 1000, queries,
+                )
@@ -0,0 +1,185 @@
+"""
+Ограничение частоты запросов и сброс нагрузки для публичных роутов.
+
+- enforce(route, request, telegram_id) — token bucket на процесс по
+  telegram_id и по IP с бюджетом роута (BUDGETS, переопределяется
+  RATE_LIMIT_<ROUTE>_<KIND>=N/sec|min|hour); превышение — 429 + Retry-After;
+- LoadShedMiddleware — пока лаг event loop выше SHED_LOOP_LAG_MS или все
+  соединения пула БД заняты, /api/ отвечает 503 + Retry-After, не
+  доходя до БД. Админка (/api/admin/) не отсекается.
+
+Лимиты считаются в каждом процессе отдельно: при N воркерах клиент в
+худшем случае получает N бюджетов.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") not in ("0", "false", "no")
+MAX_BUCKETS = 50_000
+SHED_LOOP_LAG_MS = float(os.getenv("SHED_LOOP_LAG_MS", "250"))     # 0 — без сброса по лагу
+SHED_RETRY_AFTER = 2
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))     # прокси перед приложением (railway.toml)
+LAG_CHECK_INTERVAL = 0.1
+
+# route → {kind: "N/период"}
+BUDGETS = {
+    "orders": {"telegram_id": "10/min", "ip": "60/min"},
+    "check_rep": {"telegram_id": "30/min", "ip": "120/min"},
+    "search": {"ip": "120/min"},
+    "auth": {"ip": "60/min"},
+}
+
+PERIODS = {"sec": 1, "min": 60, "hour": 3600}
+
+THROTTLED = metrics.register(metrics.Counter(
+    "rate_limited_total", "Запросов отклонено лимитом частоты", ("route", "kind")))
+SHED = metrics.register(metrics.Counter(
+    "load_shed_total", "Запросов отклонено при перегрузке", ("reason",)))
+
+
+def _parse(spec: str) -> tuple[float, float]:
+    """'10/min' → (ёмкость, пополнение в секунду)"""
+    count, _, period = spec.partition("/")
+    capacity = float(count)
+    return capacity, capacity / PERIODS[period.strip() or "sec"]
+
+
+def _load_budgets() -> dict[tuple[str, str], tuple[float, float]]:
+    budgets = {}
+    for route, kinds in BUDGETS.items():
+        for kind, spec in kinds.items():
+            spec = os.getenv(f"RATE_LIMIT_{route.upper()}_{kind.upper()}", spec)
+            budgets[(route, kind)] = _parse(spec)
+    return budgets
+
+
+_budgets = _load_budgets()
+_buckets: "OrderedDict[tuple, tuple[float, float]]" = OrderedDict()    # ключ → (токены, время)
+
+
+def _take(route: str, kind: str, value) -> float:
+    """Взять токен; 0 — можно, иначе через сколько секунд появится следующий"""
+    capacity, rate = _budgets[(route, kind)]
+    key = (route, kind, value)
+    now = time.monotonic()
+    tokens, updated = _buckets.pop(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    wait = 0.0
+    if tokens >= 1:
+        tokens -= 1
+    else:
+        wait = (1 - tokens) / rate
+    _buckets[key] = (tokens, now)
+    if len(_buckets) > MAX_BUCKETS:
+        _buckets.popitem(last=False)
+    return wait
+
+
+def client_ip(request: Request) -> str:
+    """
+    Адрес клиента. Левые записи X-Forwarded-For клиент пишет сам, поэтому
+    берётся та, что добавил наш прокси: TRUSTED_PROXY_HOPS-я справа.
+    По умолчанию 0 — заголовку не верим (без прокси его подделает любой);
+    на Railway один прокси, там задано 1.
+    """
+    forwarded = request.headers.get("x-forwarded-for") if TRUSTED_PROXY_HOPS else None
+    if forwarded:
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        if hops:
+            return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    return request.client.host if request.client else ""
+
+
+def enforce(route: str, request: Request, telegram_id: Optional[int] = None):
+    """Проверить бюджет роута; при превышении — HTTPException 429"""
+    if not RATE_LIMIT_ENABLED:
+        return
+    keys = {"ip": client_ip(request), "telegram_id": telegram_id}
+    for kind, value in keys.items():
+        if value is None or (route, kind) not in _budgets:
+            continue
+        wait = _take(route, kind, value)
+        if wait:
+            THROTTLED.inc(route, kind)
+            raise HTTPException(429, "Слишком много запросов, попробуйте позже",
+                                headers={"Retry-After": str(max(1, round(wait)))})
+
+
+# ─── Сброс нагрузки ──────────────────────────────────────────
+
+_loop_lag = 0.0
+_task: Optional[asyncio.Task] = None
+
+
+def loop_lag() -> float:
+    return _loop_lag
+
+
+async def _watch_loop():
+    global _loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_CHECK_INTERVAL)
+        _loop_lag = max(0.0, loop.time() - started - LAG_CHECK_INTERVAL)
+
+
+def start():
+    global _task
+    _task = asyncio.create_task(_watch_loop())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+
+
+def _pool_saturated(engine, capacity: Optional[int]) -> bool:
+    """Все соединения пула (с overflow) выданы — новый запрос встанет в очередь"""
+    pool = engine.sync_engine.pool
+    if capacity is None or not hasattr(pool, "checkedout"):
+        return False        # NullPool / SQLite без пула
+    return pool.checkedout() >= capacity
+
+
+class LoadShedMiddleware:
+    """ASGI-middleware: 503 на /api/ при перегрузке процесса"""
+
+    def __init__(self, app, engine, pool_capacity: Optional[int] = None,
+                 prefixes: tuple = ("/api/",), exclude: tuple = ("/api/admin/",)):
+        self.app = app
+        self.engine = engine
+        self.pool_capacity = pool_capacity      # db.engine.pool_capacity — из тех же настроек, что и пул
+        self.prefixes = prefixes
+        self.exclude = exclude
+
+    def _overloaded(self) -> Optional[str]:
+        if SHED_LOOP_LAG_MS and _loop_lag * 1000 >= SHED_LOOP_LAG_MS:
+            return "loop_lag"
+        if _pool_saturated(self.engine, self.pool_capacity):
+            return "db_pool"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http" and scope["path"].startswith(self.prefixes)
+                and not scope["path"].startswith(self.exclude)):
+            reason = self._overloaded()
+            if reason:
+                SHED.inc(reason)
+                response = JSONResponse(
+                    {"detail": "Сервер перегружен, попробуйте позже"},
+                    status_code=503, headers={"Retry-After": str(SHED_RETRY_AFTER)},
+                )
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
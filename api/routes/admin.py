@@ -1,12 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import update, delete, select
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import Optional
-from db.models import get_db, Product, Order, Representative
-from db import crud
+from datetime import date, datetime, timedelta
+from fastapi.responses import StreamingResponse
+from db.models import get_db, AsyncSessionLocal, Product, Order
+from db import crud, catalog, rep_cache, stats
+from api import export, sheets_worker
+from bot import notifier, broadcast
 import os
-import json
+import base64
+import codecs
+import csv
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
 
@@ -26,6 +32,11 @@ async def ping():
     return {"ok": True, "token_set": bool(token), "token_len": len(token)}
 
 
+@router.get("/cache")
+async def cache_stats(_=Depends(check_admin_token)):
+    return {"reps": rep_cache.stats()}
+
+
 # ════════════════════════════════════════════════════════════
 #  PRODUCTS
 # ════════════════════════════════════════════════════════════
@@ -68,6 +79,7 @@ async def admin_create_product(payload: ProductCreate, db: AsyncSession = Depend
     db.add(product)
     await db.commit()
     await db.refresh(product)
+    catalog.invalidate()
     return {"ok": True, "id": product.id}
 
 
@@ -79,6 +91,7 @@ async def admin_update_product(product_id: int, payload: ProductUpdate,
         raise HTTPException(400, "Нет данных для обновления")
     await db.execute(update(Product).where(Product.id == product_id).values(**values))
     await db.commit()
+    catalog.invalidate()
     return {"ok": True}
 
 
@@ -86,6 +99,7 @@ async def admin_update_product(product_id: int, payload: ProductUpdate,
 async def admin_delete_product(product_id: int, db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
     await db.execute(delete(Product).where(Product.id == product_id))
     await db.commit()
+    catalog.invalidate()
     return {"ok": True}
 
 
@@ -97,9 +111,140 @@ async def admin_toggle_product(product_id: int, db: AsyncSession = Depends(get_d
         raise HTTPException(404, "Препарат не найден")
     await db.execute(update(Product).where(Product.id == product_id).values(is_active=not product.is_active))
     await db.commit()
+    catalog.invalidate()
     return {"ok": True, "is_active": not product.is_active}
 
 
+async def read_csv_rows(request: Request):
+    """
+    Построчный разбор CSV из тела запроса по мере поступления.
+    Первая строка — заголовок (name, description, unit, stock, price, limit_per_order),
+    разделитель «,» или «;».
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, record = "", ""
+    header, delimiter = None, ","
+
+    def parse(text: str):
+        nonlocal header, delimiter
+        if not text.strip():
+            return None
+        if header is None:
+            delimiter = ";" if text.count(";") > text.count(",") else ","
+            header = [h.strip().lower() for h in next(csv.reader([text], delimiter=delimiter))]
+            return None
+        values = next(csv.reader([text], delimiter=delimiter))
+        return {k: v.strip() for k, v in zip(header, values) if v.strip() != ""}
+
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            record += line.rstrip("\r")
+            if record.count('"') % 2:          # перенос строки внутри кавычек
+                record += "\n"
+                continue
+            row = parse(record)
+            record = ""
+            if row is not None:
+                yield row
+    row = parse(record + buffer + decoder.decode(b"", final=True))
+    if row is not None:
+        yield row
+
+
+def validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+
+
+@router.post("/products/bulk")
+async def admin_bulk_products(request: Request, db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    """Импорт каталога: JSON-массив ProductCreate или CSV (Content-Type: text/csv). Upsert по названию."""
+    if "csv" in request.headers.get("content-type", ""):
+        raw_rows = [row async for row in read_csv_rows(request)]
+    else:
+        body = await request.json()
+        raw_rows = body if isinstance(body, list) else body.get("products", [])
+
+    results, valid = [], []
+    for number, raw in enumerate(raw_rows, 1):
+        try:
+            row = ProductCreate.model_validate(raw).model_dump(exclude_unset=True)
+        except ValidationError as e:
+            results.append({"row": number, "status": "error", "error": validation_message(e)})
+            continue
+        row["name"] = row["name"].strip()
+        if not row["name"]:
+            results.append({"row": number, "status": "error", "error": "name: пустое название"})
+            continue
+        valid.append((number, row))
+
+    outcome = await crud.bulk_upsert_products(db, [row for _, row in valid]) if valid else {}
+    for number, row in valid:
+        status, product_id = outcome[row["name"]]
+        results.append({"row": number, "name": row["name"], "status": status, "id": product_id})
+    results.sort(key=lambda r: r["row"])
+    if valid:
+        catalog.invalidate()
+    return {
+        "ok": True,
+        "created": sum(r["status"] == "created" for r in results),
+        "updated": sum(r["status"] == "updated" for r in results),
+        "errors": sum(r["status"] == "error" for r in results),
+        "results": results,
+    }
+
+
+# ════════════════════════════════════════════════════════════
+#  STOCK
+# ════════════════════════════════════════════════════════════
+
+class StockAdjustment(BaseModel):
+    product_id: int
+    stock: Optional[int] = None      # установить остаток
+    delta: Optional[int] = None      # или изменить на +/- delta
+
+
+class StockBulk(BaseModel):
+    items: list[StockAdjustment]
+
+
+@router.post("/stock/bulk")
+async def admin_bulk_stock(payload: StockBulk, db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    results: dict[int, dict] = {}
+    absolute, delta = {}, {}
+    for item in payload.items:
+        pid = item.product_id
+        if pid in absolute or pid in delta or pid in results:
+            results[pid] = {"product_id": pid, "status": "error", "error": "Препарат указан несколько раз"}
+        elif (item.stock is None) == (item.delta is None):
+            results[pid] = {"product_id": pid, "status": "error", "error": "Нужно указать stock или delta"}
+        elif item.stock is not None and item.stock < 0:
+            results[pid] = {"product_id": pid, "status": "error", "error": "Остаток не может быть отрицательным"}
+        elif item.stock is not None:
+            absolute[pid] = item.stock
+        else:
+            delta[pid] = item.delta
+    for pid in results:
+        absolute.pop(pid, None)
+        delta.pop(pid, None)
+
+    outcome = await crud.bulk_adjust_stock(db, absolute, delta) if absolute or delta else {}
+    messages = {"not_found": "Препарат не найден", "insufficient": "Остаток ушёл бы в минус"}
+    for pid, (status, stock) in outcome.items():
+        results[pid] = {"product_id": pid, "status": status, "stock": stock}
+        if status in messages:
+            results[pid]["error"] = messages[status]
+    if any(r["status"] == "ok" for r in results.values()):
+        catalog.invalidate()
+    return {
+        "ok": True,
+        "updated": sum(r["status"] == "ok" for r in results.values()),
+        "errors": sum(r["status"] != "ok" for r in results.values()),
+        "results": list(results.values()),
+    }
+
+
 # ════════════════════════════════════════════════════════════
 #  REPRESENTATIVES
 # ════════════════════════════════════════════════════════════
@@ -139,6 +284,7 @@ async def admin_create_rep(payload: RepCreate, db: AsyncSession = Depends(get_db
     if existing_tg:
         raise HTTPException(400, f"Telegram ID {payload.telegram_id} уже зарегистрирован")
     rep = await crud.create_rep(db, payload.code, payload.telegram_id, payload.full_name)
+    rep_cache.invalidate()
     return {"ok": True, "id": rep.id}
 
 
@@ -146,14 +292,15 @@ async def admin_create_rep(payload: RepCreate, db: AsyncSession = Depends(get_db
 async def admin_update_rep(rep_id: int, payload: RepUpdate,
                             db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
     values = {k: v for k, v in payload.model_dump().items() if v is not None}
-    await db.execute(update(Representative).where(Representative.id == rep_id).values(**values))
-    await db.commit()
+    await crud.update_rep(db, rep_id, **values)
+    rep_cache.invalidate()
     return {"ok": True}
 
 
 @router.delete("/reps/{rep_id}")
 async def admin_delete_rep(rep_id: int, db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
     await crud.delete_rep(db, rep_id)
+    rep_cache.invalidate()
     return {"ok": True}
 
 
@@ -161,11 +308,89 @@ async def admin_delete_rep(rep_id: int, db: AsyncSession = Depends(get_db), _=De
 #  ORDERS
 # ════════════════════════════════════════════════════════════
 
+ORDER_STATUSES = ("new", "processing", "done", "cancelled")
+
+
+def encode_cursor(order: Order) -> str:
+    raw = f"{order.created_at.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, order_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except ValueError:
+        raise HTTPException(400, "Неверный cursor")
+
+
 @router.get("/orders")
-async def admin_list_orders(db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
-    orders = await crud.get_orders(db, limit=100)
-    result = await db.execute(select(Product))
-    products = {p.id: p for p in result.scalars().all()}
+async def admin_list_orders(cursor: Optional[str] = None,
+                            limit: int = Query(100, ge=1, le=500),
+                            status: Optional[str] = None,
+                            rep_code: Optional[str] = None,
+                            institution: Optional[str] = None,
+                            date_from: Optional[date] = Query(None, alias="from"),
+                            date_to: Optional[date] = Query(None, alias="to"),
+                            db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    if status and status not in ORDER_STATUSES:
+        raise HTTPException(400, "Неверный статус")
+    orders, has_more = await crud.get_orders_page(
+        db,
+        limit=limit,
+        after=decode_cursor(cursor) if cursor else None,
+        status=status,
+        rep_code=rep_code,
+        institution=institution,
+        created_from=datetime.combine(date_from, datetime.min.time()) if date_from else None,
+        created_to=datetime.combine(date_to + timedelta(days=1), datetime.min.time()) if date_to else None,
+    )
+    return {
+        "items": serialize_orders(orders),
+        "next_cursor": encode_cursor(orders[-1]) if has_more else None,
+    }
+
+
+@router.get("/orders/export")
+async def admin_export_orders(format: str = "csv",
+                              status: Optional[str] = None,
+                              rep_code: Optional[str] = None,
+                              institution: Optional[str] = None,
+                              date_from: Optional[date] = Query(None, alias="from"),
+                              date_to: Optional[date] = Query(None, alias="to"),
+                              _=Depends(check_admin_token)):
+    """Вся история заявок построчно (позиция = строка), потоком"""
+    if format not in ("csv", "xlsx"):
+        raise HTTPException(400, "format должен быть csv или xlsx")
+    if status and status not in ORDER_STATUSES:
+        raise HTTPException(400, "Неверный статус")
+    filters = dict(
+        status=status,
+        rep_code=rep_code,
+        institution=institution,
+        created_from=datetime.combine(date_from, datetime.min.time()) if date_from else None,
+        created_to=datetime.combine(date_to + timedelta(days=1), datetime.min.time()) if date_to else None,
+    )
+
+    async def batches():
+        # Своя сессия: Depends(get_db) закрывается до окончания стриминга
+        async with AsyncSessionLocal() as db:
+            async for batch in crud.stream_order_lines(db, **filters):
+                yield batch
+
+    if format == "xlsx":
+        body = export.xlsx_stream(batches())
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        body = export.csv_stream(batches())
+        media_type = "text/csv; charset=utf-8"
+    filename = f"orders_{datetime.now():%Y%m%d_%H%M}.{format}"
+    return StreamingResponse(body, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+def serialize_orders(orders: list[Order]) -> list[dict]:
     return [
         {
             "id": o.id,
@@ -175,16 +400,21 @@ async def admin_list_orders(db: AsyncSession = Depends(get_db), _=Depends(check_
             "username": o.telegram_username or "",
             "institution": o.institution,
             "status": o.status,
+            "next_statuses": list(crud.ORDER_TRANSITIONS.get(o.status, ())),
             "total_items": o.total_items,
             "total_price": o.total_price,
             "payment_percent": o.payment_percent,
             "payment_amount": o.payment_amount,
             "items": [
                 {
-                    **item,
-                    "product_name": products[item["product_id"]].name if item["product_id"] in products else "?",
+                    "product_id": i.product_id,
+                    "quantity": i.quantity,
+                    "price": i.price,
+                    "line_total": i.line_total,
+                    "unit": i.unit,
+                    "product_name": i.product_name,
                 }
-                for item in json.loads(o.items_json)
+                for i in o.items
             ],
         }
         for o in orders
@@ -195,7 +425,154 @@ async def admin_list_orders(db: AsyncSession = Depends(get_db), _=Depends(check_
 async def admin_update_order_status(order_id: int, payload: dict,
                                      db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
     status = payload.get("status", "")
-    if status not in ("new", "processing", "done", "cancelled"):
+    if status not in ORDER_STATUSES:
+        raise HTTPException(400, "Неверный статус")
+    result, previous = (await _change_statuses(db, [order_id], status))[order_id]
+    if result == "not_found":
+        raise HTTPException(404, "Заявка не найдена")
+    if result in ("not_allowed", "conflict"):
+        raise HTTPException(409, f"Переход «{previous}» → «{status}» недопустим")
+    return {"ok": True}
+
+
+async def _change_statuses(db: AsyncSession, ids: list[int], status: str) -> dict[int, tuple[str, Optional[str]]]:
+    """
+    Смена статуса по ORDER_TRANSITIONS с остатками, агрегатами, статусом
+    в таблице и уведомлениями представителям — общая для одной и многих заявок.
+    """
+    outcome, restocked = await crud.bulk_update_order_status(db, ids, status)
+    changed = [order_id for order_id, (result, previous) in outcome.items() if result == "ok"]
+    sheet_rows = await crud.get_sheet_rows(db, changed)
+    owners = await crud.get_order_owners(db, changed)
+    await db.commit()
+
+    if restocked:
+        catalog.stock_changed(
+            {pid: stock for pid, (stock, _) in restocked.items()},
+            {pid: returned for pid, (_, returned) in restocked.items()},
+        )
+    sheets_worker.update_statuses({row: status for row in sheet_rows.values()})
+    for order_id, telegram_id in owners.items():
+        notifier.status_changed(order_id, telegram_id, status)
+    return outcome
+
+
+class OrderFilter(BaseModel):
+    status: Optional[str] = None
+    rep_code: Optional[str] = None
+    institution: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+
+
+class BulkStatusUpdate(BaseModel):
+    status: str
+    ids: Optional[list[int]] = None
+    filter: Optional[OrderFilter] = None
+
+
+BULK_STATUS_LIMIT = 5000
+
+
+@router.post("/orders/status/bulk")
+async def admin_bulk_order_status(payload: BulkStatusUpdate,
+                                  db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    """
+    Массовая смена статуса: список ids или фильтр как в GET /orders.
+    Переходы: new → processing → done, отмена — из любого статуса.
+    """
+    if payload.status not in ORDER_STATUSES:
         raise HTTPException(400, "Неверный статус")
-    await crud.update_order_status(db, order_id, status)
+    if payload.ids is None and payload.filter is None:
+        raise HTTPException(400, "Нужен ids или filter")
+    if payload.ids is not None:
+        ids = payload.ids
+    else:
+        f = payload.filter
+        if f.status and f.status not in ORDER_STATUSES:
+            raise HTTPException(400, "Неверный статус в фильтре")
+        ids = await crud.get_order_ids(
+            db, limit=BULK_STATUS_LIMIT + 1,
+            status=f.status,
+            rep_code=f.rep_code,
+            institution=f.institution,
+            created_from=datetime.combine(f.date_from, datetime.min.time()) if f.date_from else None,
+            created_to=datetime.combine(f.date_to + timedelta(days=1), datetime.min.time()) if f.date_to else None,
+        )
+    if len(ids) > BULK_STATUS_LIMIT:
+        raise HTTPException(400, f"Не больше {BULK_STATUS_LIMIT} заявок за раз — сузьте фильтр")
+
+    outcome = await _change_statuses(db, ids, payload.status)
+
+    summary: dict[str, int] = {}
+    for result, previous in outcome.values():
+        summary[result] = summary.get(result, 0) + 1
+    return {
+        "status": payload.status,
+        "summary": summary,
+        "results": [
+            {"id": order_id, "result": result, "previous": previous}
+            for order_id, (result, previous) in outcome.items()
+        ],
+    }
+
+
+# ════════════════════════════════════════════════════════════
+#  STATS
+# ════════════════════════════════════════════════════════════
+
+@router.get("/stats")
+async def admin_stats(group_by: str = "rep",
+                      date_from: Optional[date] = Query(None, alias="from"),
+                      date_to: Optional[date] = Query(None, alias="to"),
+                      db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    """Сводка продаж из дневных агрегатов: group_by = day | rep | institution | product"""
+    if group_by not in stats.GROUPS:
+        raise HTTPException(400, f"group_by: одно из {', '.join(stats.GROUPS)}")
+    return {"group_by": group_by, "rows": await stats.summary(db, group_by, date_from, date_to)}
+
+
+@router.post("/stats/rebuild")
+async def admin_rebuild_stats(db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    await stats.rebuild(db)
+    await db.commit()
     return {"ok": True}
+
+
+# ════════════════════════════════════════════════════════════
+#  BROADCAST
+# ════════════════════════════════════════════════════════════
+
+class BroadcastCreate(BaseModel):
+    text: str
+
+
+@router.post("/broadcast")
+async def admin_create_broadcast(payload: BroadcastCreate,
+                                 db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    """Рассылка всем активным представителям; отправляет фоновый исполнитель"""
+    text = payload.text.strip()
+    if not text:
+        raise HTTPException(400, "Пустой текст")
+    if len(text) > 4096:
+        raise HTTPException(400, "Текст длиннее 4096 символов")
+    job, total = await crud.create_broadcast(db, text)
+    broadcast.notify()
+    return {"id": job.id, "total": total}
+
+
+@router.get("/broadcast/{broadcast_id}")
+async def admin_broadcast_status(broadcast_id: int,
+                                 db: AsyncSession = Depends(get_db), _=Depends(check_admin_token)):
+    job = await crud.get_broadcast(db, broadcast_id)
+    if job is None:
+        raise HTTPException(404, "Рассылка не найдена")
+    counts = await crud.broadcast_progress(db, broadcast_id)
+    return {
+        "id": job.id,
+        "status": job.status,
+        "total": sum(counts.values()),
+        "counts": counts,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel
+from db.models import get_db
+from db import rep_cache
+from api import auth, ratelimit
+
+router = APIRouter(prefix="/api/auth", tags=["auth"])
+
+
+class WebAppAuth(BaseModel):
+    init_data: str
+
+
+@router.post("/webapp")
+async def webapp_auth(payload: WebAppAuth, request: Request, db: AsyncSession = Depends(get_db)):
+    """Проверка initData Telegram и выдача токена сессии Mini App"""
+    ratelimit.enforce("auth", request)
+    user = auth.verify_init_data(payload.init_data)
+    if user is None or "id" not in user:
+        raise HTTPException(401, "Неверная подпись Telegram")
+    rep = await rep_cache.get_by_telegram_id(db, user["id"])
+    if not rep or not rep.is_active:
+        return {"registered": False}
+    token, expires_at = auth.issue_token(rep)
+    return {
+        "registered": True, "code": rep.code, "full_name": rep.full_name,
+        "token": token, "expires_at": expires_at,
+    }
@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from typing import Optional
 from db.models import get_db
-from db import crud
-from api.sheets import append_order_to_sheet
+from db import crud, catalog, rep_cache
+from db.rep_cache import RepInfo
+from db.catalog import LOW_STOCK
+from api import sheets, sheets_worker, idempotency, ratelimit, auth
+from bot import notifier
 
 router = APIRouter(prefix="/api/orders", tags=["orders"])
 
@@ -23,38 +26,65 @@ class OrderCreate(BaseModel):
 
 
 @router.post("/")
-async def create_order(payload: OrderCreate, db: AsyncSession = Depends(get_db)):
+async def create_order(payload: OrderCreate, request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Оформление заявки. Повтор с тем же Idempotency-Key не создаёт
+    вторую заявку, а возвращает первый ответ.
+    """
+    ratelimit.enforce("orders", request, payload.telegram_id)
+    # Токен сессии Mini App — представитель без запроса к БД
+    rep = await auth.rep_from_request(request, db)
+    if rep is not None and rep.telegram_id != payload.telegram_id:
+        raise HTTPException(403, "Токен выдан другому пользователю")
+    key = idempotency.key_for(request, payload.telegram_id)
+    if key is None:
+        return await place_order(payload, db, rep=rep)
+    return await idempotency.run(key, payload.model_dump(), lambda key: place_order(payload, db, idempotency_key=key, rep=rep))
+
+
+async def place_order(payload: OrderCreate, db: AsyncSession, idempotency_key: Optional[str] = None,
+                      rep: Optional[RepInfo] = None) -> dict:
     if not payload.items:
         raise HTTPException(400, "Корзина пустая")
     if payload.payment_percent not in (50, 100):
         raise HTTPException(400, "payment_percent должен быть 50 или 100")
 
     # Проверяем что пользователь зарегистрирован
-    rep = await crud.get_rep_by_telegram_id(db, payload.telegram_id)
+    if rep is None:
+        rep = await rep_cache.get_by_telegram_id(db, payload.telegram_id)
     if not rep:
         raise HTTPException(403, "Вы не зарегистрированы как медпредставитель. Обратитесь к администратору.")
     if not rep.is_active:
         raise HTTPException(403, "Ваш аккаунт деактивирован.")
 
-    # Проверяем остатки и лимиты
+    # Все препараты корзины — одним запросом
+    products = await crud.get_products_by_ids(db, (i.product_id for i in payload.items))
+
+    # Проверяем остатки и лимиты (повторяющиеся позиции суммируем)
+    wanted: dict[int, int] = {}
     for item in payload.items:
-        product = await crud.get_product(db, item.product_id)
+        if item.quantity <= 0:
+            raise HTTPException(400, "Количество должно быть больше нуля")
+        wanted[item.product_id] = wanted.get(item.product_id, 0) + item.quantity
+    for product_id, quantity in wanted.items():
+        product = products.get(product_id)
         if not product:
-            raise HTTPException(404, f"Препарат {item.product_id} не найден")
-        if product.stock < item.quantity:
-            raise HTTPException(400, f"Недостаточно «{product.name}»: доступно {product.stock} {product.unit}")
-        if product.limit_per_order and item.quantity > product.limit_per_order:
+            raise HTTPException(404, f"Препарат {product_id} не найден")
+        if product.stock < quantity:
+            raise HTTPException(409, f"Недостаточно «{product.name}»: доступно {product.stock} {product.unit}")
+        if product.limit_per_order and quantity > product.limit_per_order:
             raise HTTPException(400, f"Лимит «{product.name}»: не более {product.limit_per_order} {product.unit} за раз")
 
     # Считаем сумму
     total_price = 0.0
     items_dicts = []
     for item in payload.items:
-        product = await crud.get_product(db, item.product_id)
+        product = products[item.product_id]
         line_total = round(product.price * item.quantity, 2)
         total_price += line_total
         items_dicts.append({
             "product_id": item.product_id,
+            "product_name": product.name,
             "quantity": item.quantity,
             "price": product.price,
             "line_total": line_total,
@@ -62,11 +92,14 @@ async def create_order(payload: OrderCreate, db: AsyncSession = Depends(get_db))
         })
     total_price = round(total_price, 2)
 
-    # Списываем остатки
-    if not await crud.deduct_stock(db, [{"product_id": i["product_id"], "quantity": i["quantity"]} for i in items_dicts]):
-        raise HTTPException(400, "Ошибка списания остатков, попробуйте снова")
+    # Списываем остатки и создаём заказ в одной транзакции.
+    # Условный UPDATE не даст уйти в минус, даже если параллельная заявка
+    # успела списать остаток после нашей проверки выше.
+    remaining = await crud.deduct_stock(db, items_dicts)
+    if remaining is None:
+        await db.rollback()
+        raise HTTPException(409, "Остатки изменились, пока вы оформляли заявку. Обновите каталог и попробуйте снова")
 
-    # Создаём заказ
     order = await crud.create_order(
         db,
         telegram_id=payload.telegram_id,
@@ -79,29 +112,22 @@ async def create_order(payload: OrderCreate, db: AsyncSession = Depends(get_db))
         payment_percent=payload.payment_percent,
     )
 
-    # Google Sheets
-    try:
-        products_map = {}
-        for i in items_dicts:
-            p = await crud.get_product(db, i["product_id"])
-            if p:
-                products_map[i["product_id"]] = p.name
-        append_order_to_sheet(
+    # Google Sheets — строка уходит в outbox в той же транзакции,
+    # выгружает её фоновый воркер
+    if sheets.is_configured():
+        await crud.enqueue_sheet_row(db, order.id, sheets.build_order_row(
             order_id=order.id,
             rep_code=rep.code,
             full_name=rep.full_name,
             username=payload.telegram_username,
             institution=payload.institution,
             items=items_dicts,
-            products_map=products_map,
+            products_map={pid: p.name for pid, p in products.items()},
             total_price=total_price,
             payment_percent=payload.payment_percent,
             payment_amount=order.payment_amount,
-        )
-    except Exception as e:
-        print(f"[Sheets ERROR] {e}")
-
-    return {
+        ))
+    response = {
         "ok": True,
         "order_id": order.id,
         "rep_code": rep.code,
@@ -109,12 +135,34 @@ async def create_order(payload: OrderCreate, db: AsyncSession = Depends(get_db))
         "payment_amount": order.payment_amount,
         "payment_percent": payload.payment_percent,
     }
+    if idempotency_key and not await idempotency.complete(db, idempotency_key, response):
+        # Ключ перехватил другой запрос — эту заявку не фиксируем
+        await db.rollback()
+        raise idempotency.busy()
+    await db.commit()
+    catalog.stock_changed(remaining, {pid: -quantity for pid, quantity in wanted.items()})
+    sheets_worker.notify()
+
+    # Уведомления уходят из фоновой очереди — ответ их не ждёт
+    notifier.order_created(
+        order.id, payload.telegram_id, rep.code, rep.full_name, payload.institution,
+        items_dicts, order.payment_amount, payload.payment_percent,
+    )
+    # Порог сравнивается с остатком после UPDATE, а не со снимком до него:
+    # параллельная заявка могла списать часть между чтением и списанием
+    notifier.low_stock([
+        (products[pid].name, stock, products[pid].unit)
+        for pid, stock in remaining.items()
+        if stock < LOW_STOCK <= stock + wanted[pid]
+    ])
+    return response
 
 
 @router.get("/check-rep/{telegram_id}")
-async def check_rep(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def check_rep(telegram_id: int, request: Request, db: AsyncSession = Depends(get_db)):
     """Проверка — зарегистрирован ли пользователь"""
-    rep = await crud.get_rep_by_telegram_id(db, telegram_id)
+    ratelimit.enforce("check_rep", request, telegram_id)
+    rep = await rep_cache.get_by_telegram_id(db, telegram_id)
     if not rep or not rep.is_active:
         return {"registered": False}
     return {"registered": True, "code": rep.code, "full_name": rep.full_name}
@@ -1,24 +1,32 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.ext.asyncio import AsyncSession
-from db.models import get_db
-from db import crud
+from fastapi import APIRouter, Request, Response, Query, HTTPException
+from typing import Optional
+from db import catalog, search
+from api import ratelimit
 
 router = APIRouter(prefix="/api/products", tags=["products"])
 
 
 @router.get("/")
-async def list_products(db: AsyncSession = Depends(get_db)):
-    products = await crud.get_all_products(db)
-    return [
-        {
-            "id": p.id,
-            "name": p.name,
-            "description": p.description,
-            "unit": p.unit,
-            "stock": p.stock,
-            "price": p.price,
-            "limit_per_order": p.limit_per_order,
-            "available": p.stock > 0,
-        }
-        for p in products
-    ]
+async def list_products(request: Request):
+    snapshot = await catalog.get_snapshot()
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if_none_match = [t.strip() for t in request.headers.get("if-none-match", "").split(",")]
+    if snapshot.etag in if_none_match or "*" in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+
+@router.get("/search")
+async def search_products(request: Request, q: str = "", limit: int = Query(20, ge=1, le=100),
+                          cursor: Optional[str] = None):
+    """Поиск по названию и описанию с учётом опечаток, результаты по релевантности"""
+    ratelimit.enforce("search", request)
+    if cursor is not None and not cursor.isdigit():
+        raise HTTPException(400, "Неверный cursor")
+    offset = int(cursor or 0)
+    results = await search.search(q)
+    return {
+        "items": results[offset:offset + limit],
+        "total": len(results),
+        "next_cursor": str(offset + limit) if offset + limit < len(results) else None,
+    }
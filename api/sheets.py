@@ -1,7 +1,7 @@
-import gspread
-from google.oauth2.service_account import Credentials
 import json
 import os
+import re
+import threading
 from datetime import datetime
 
 SCOPES = [
@@ -15,8 +15,24 @@ SHEET_HEADERS = [
     "Сумма полная", "Оплата %", "К оплате", "Статус"
 ]
 
+STATUS_LABELS = {"new": "Новая", "processing": "В работе", "done": "Выполнена", "cancelled": "Отменена"}
+STATUS_COLUMN = "K"
+STATUS_INDEX = ord(STATUS_COLUMN) - ord("A")       # позиция статуса в строке build_order_row
+
+
+_lock = threading.Lock()
+_worksheet = None
+
+
+def is_configured() -> bool:
+    return bool(os.getenv("GOOGLE_SHEET_ID") and os.getenv("GOOGLE_CREDENTIALS_JSON"))
+
 
 def get_sheets_client():
+    # gspread и google-auth тяжёлые — импортируем при первом обращении, а не на старте
+    import gspread
+    from google.oauth2.service_account import Credentials
+
     creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
     if not creds_json:
         raise ValueError("GOOGLE_CREDENTIALS_JSON не задан")
@@ -25,28 +41,41 @@ def get_sheets_client():
 
 
 def get_or_create_worksheet():
-    client = get_sheets_client()
-    spreadsheet = client.open_by_key(os.getenv("GOOGLE_SHEET_ID"))
-    try:
-        ws = spreadsheet.worksheet("Заявки")
-    except gspread.WorksheetNotFound:
-        ws = spreadsheet.add_worksheet("Заявки", rows=1000, cols=20)
-        ws.append_row(SHEET_HEADERS)
-        ws.format("A1:K1", {
-            "backgroundColor": {"red": 0.2, "green": 0.6, "blue": 0.9},
-            "textFormat": {"bold": True, "foregroundColor": {"red": 1, "green": 1, "blue": 1}}
-        })
-    return ws
-
-
-def append_order_to_sheet(order_id, rep_code, full_name, username, institution,
-                           items, products_map, total_price, payment_percent, payment_amount):
-    ws = get_or_create_worksheet()
+    """Лист «Заявки»; клиент и лист кэшируются на процесс"""
+    global _worksheet
+    with _lock:
+        if _worksheet is not None:
+            return _worksheet
+        import gspread
+        client = get_sheets_client()
+        spreadsheet = client.open_by_key(os.getenv("GOOGLE_SHEET_ID"))
+        try:
+            ws = spreadsheet.worksheet("Заявки")
+        except gspread.WorksheetNotFound:
+            ws = spreadsheet.add_worksheet("Заявки", rows=1000, cols=20)
+            ws.append_row(SHEET_HEADERS)
+            ws.format("A1:K1", {
+                "backgroundColor": {"red": 0.2, "green": 0.6, "blue": 0.9},
+                "textFormat": {"bold": True, "foregroundColor": {"red": 1, "green": 1, "blue": 1}}
+            })
+        _worksheet = ws
+        return ws
+
+
+def reset_worksheet():
+    """Сбросить кэш после ошибки — при следующей попытке лист откроется заново"""
+    global _worksheet
+    with _lock:
+        _worksheet = None
+
+
+def build_order_row(order_id, rep_code, full_name, username, institution,
+                    items, products_map, total_price, payment_percent, payment_amount) -> list:
     items_str = "; ".join(
         f"{products_map.get(i['product_id'], '?')}: {i['quantity']} {i.get('unit','шт')} × {i.get('price',0):.2f}"
         for i in items
     )
-    row = [
+    return [
         order_id,
         datetime.now().strftime("%d.%m.%Y %H:%M"),
         rep_code,
@@ -57,7 +86,29 @@ def append_order_to_sheet(order_id, rep_code, full_name, username, institution,
         f"{total_price:.2f}",
         f"{payment_percent}%",
         f"{payment_amount:.2f}",
-        "Новая",
+        STATUS_LABELS["new"],
     ]
-    ws.append_row(row)
-    return len(ws.get_all_values())
+
+
+def append_rows(rows: list[list]):
+    """
+    Добавляет строки одним запросом append_rows.
+    Возвращает номер первой добавленной строки (из updatedRange ответа) или None.
+    """
+    ws = get_or_create_worksheet()
+    response = ws.append_rows(rows, value_input_option="RAW")
+    updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+
+def update_statuses(rows: dict[int, str]):
+    """Проставить статусы {номер строки: статус} одним batch_update"""
+    if not rows:
+        return
+    ws = get_or_create_worksheet()
+    ws.batch_update(
+        [{"range": f"{STATUS_COLUMN}{row}", "values": [[STATUS_LABELS.get(status, status)]]}
+         for row, status in sorted(rows.items())],
+        value_input_option="RAW",
+    )
@@ -0,0 +1,147 @@
+"""
+Фоновая выгрузка заявок в Google Sheets.
+
+Заказ пишет строку в таблицу sheets_outbox в той же транзакции, а этот
+воркер пачками забирает её оттуда и отправляет одним append_rows.
+Строки берутся в аренду (crud.claim_sheet_rows), поэтому при нескольких
+процессах каждая строка уходит в таблицу один раз.
+Статусы после смены (update_statuses) уходят отдельным batch_update в
+фоне, без очереди: при сбое они лишь логируются. Строка из очереди
+уходит с текущим статусом заявки, а не с «Новая» на момент оформления;
+смена статуса во время самой выгрузки догоняется после неё.
+Вызовы gspread синхронные, поэтому выполняются в отдельном потоке и не
+блокируют event loop.
+"""
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+from db.models import AsyncSessionLocal
+from db import crud
+from api import sheets, metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+POLL_INTERVAL = 30        # сек — подстраховка, если notify() не вызвали
+MIN_WAIT = 1              # сек — не крутиться вхолостую, если пачка упала с ошибкой
+SHUTDOWN_TIMEOUT = 20     # сек — сколько ждать дослива очереди при остановке
+
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+_stopping = False
+_status_tasks: set = set()
+
+
+def notify():
+    """Разбудить воркер после коммита нового заказа"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+async def flush() -> int:
+    """Одна пачка: выгрузить готовые к отправке строки. Возвращает число выгруженных."""
+    async with AsyncSessionLocal() as db:
+        entries = await crud.claim_sheet_rows(db, limit=BATCH_SIZE)
+        if not entries:
+            return 0
+        order_ids = [e.order_id for e in entries]
+        statuses = await crud.get_order_statuses(db, order_ids)
+        rows = []
+        for entry in entries:
+            row = json.loads(entry.row_json)
+            row[sheets.STATUS_INDEX] = sheets.STATUS_LABELS[statuses.get(entry.order_id, "new")]
+            rows.append(row)
+        started = time.perf_counter()
+        try:
+            first_row = await asyncio.to_thread(sheets.append_rows, rows)
+        except Exception as e:
+            metrics.SHEETS_APPEND.observe(time.perf_counter() - started)
+            metrics.SHEETS_FAILURES.inc()
+            sheets.reset_worksheet()
+            logger.warning("[Sheets ERROR] %d строк отложено: %s", len(entries), e)
+            await crud.fail_sheet_rows(db, entries, str(e))
+            return 0
+        metrics.SHEETS_APPEND.observe(time.perf_counter() - started)
+        metrics.SHEETS_ROWS.inc(amount=len(entries))
+        await crud.complete_sheet_rows(db, entries, first_row)
+        if first_row is not None:
+            # Статус сменили, пока строка уходила: номера строки тогда ещё не было
+            current = await crud.get_order_statuses(db, order_ids)
+            update_statuses({
+                first_row + offset: current[entry.order_id]
+                for offset, entry in enumerate(entries)
+                if entry.order_id in current and current[entry.order_id] != statuses.get(entry.order_id)
+            })
+        return len(entries)
+
+
+async def _push_statuses(rows: dict[int, str]):
+    try:
+        await asyncio.to_thread(sheets.update_statuses, rows)
+    except Exception as e:
+        metrics.SHEETS_FAILURES.inc()
+        sheets.reset_worksheet()
+        logger.warning("[Sheets ERROR] статусы %d строк не обновлены: %s", len(rows), e)
+
+
+def update_statuses(rows: dict[int, str]):
+    """Обновить статусы в таблице после коммита: {номер строки: статус}"""
+    if not rows or not sheets.is_configured():
+        return
+    task = asyncio.create_task(_push_statuses(rows))
+    _status_tasks.add(task)
+    task.add_done_callback(_status_tasks.discard)
+
+
+async def _next_wait() -> float:
+    """До ближайшего next_attempt_at (повтор после ошибки), но не дольше POLL_INTERVAL"""
+    async with AsyncSessionLocal() as db:
+        earliest = await crud.next_sheet_attempt(db)
+    if earliest is None:
+        return POLL_INTERVAL
+    return min(max((earliest - datetime.utcnow()).total_seconds(), MIN_WAIT), POLL_INTERVAL)
+
+
+async def _run():
+    while True:
+        _wakeup.clear()
+        wait = POLL_INTERVAL
+        try:
+            while await flush() == BATCH_SIZE:
+                pass
+            wait = await _next_wait()
+        except Exception:
+            logger.exception("Sheets worker: ошибка обработки очереди")
+        if _stopping:
+            return
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start():
+    global _wakeup, _task, _stopping
+    if not sheets.is_configured():
+        logger.info("Google Sheets не настроен — выгрузка отключена")
+        return
+    _stopping = False
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    """Дослить очередь и остановить воркер"""
+    global _task, _stopping
+    if _task is None:
+        return
+    _stopping = True
+    notify()
+    try:
+        await asyncio.wait_for(_task, timeout=SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Sheets worker не успел выгрузить очередь — остаток уйдёт после рестарта")
+    _task = None
@@ -0,0 +1,217 @@
+"""
+Раздача фронтенда и сжатие ответов API.
+
+- PrecompressedStatic — файлы frontend/ читаются и сжимаются (gzip, brotli)
+  один раз при старте; отдаётся вариант по Accept-Encoding со строгим ETag
+  и Cache-Control, повторное открытие Mini App получает 304 без тела.
+  HTML — no-cache (каждое открытие сверяет ETag: после деплоя старая
+  страница не должна работать с новым API), остальное — max-age и
+  stale-while-revalidate;
+- CompressionMiddleware — gzip на лету для ответов API больше порога,
+  в том числе потоковых (выгрузка заявок).
+
+brotli — необязательная зависимость: без неё отдаётся только gzip.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import zlib
+from dataclasses import dataclass, field
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:     # pragma: no cover
+    brotli = None
+
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "300"))
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = 6
+
+# Не сжимаем: уже сжатое и то, что бессмысленно
+_INCOMPRESSIBLE = ("image/", "video/", "audio/", "application/zip", "application/gzip",
+                   "application/vnd.openxmlformats")
+
+
+def accepted_encodings(headers: list) -> set[str]:
+    """Кодировки из Accept-Encoding с q > 0"""
+    for name, value in headers:
+        if name == b"accept-encoding":
+            result = set()
+            for part in value.decode("latin-1").split(","):
+                coding, _, params = part.strip().partition(";")
+                q = params.strip()
+                if q.startswith("q="):
+                    try:
+                        if float(q[2:]) <= 0:
+                            continue
+                    except ValueError:
+                        continue
+                result.add(coding.strip().lower())
+            return result
+    return set()
+
+
+def _header(headers: list, name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+async def _send_bytes(send, status: int, headers: list, body: bytes = b""):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+# ─── Статика ─────────────────────────────────────────────────
+
+@dataclass
+class StaticFile:
+    content_type: str
+    cache_control: bytes
+    variants: dict = field(default_factory=dict)    # кодировка ("" — без сжатия) → (etag, тело)
+
+
+class PrecompressedStatic:
+    """
+    ASGI-приложение для mount("/"): все файлы каталога держатся в памяти
+    вместе со сжатыми вариантами. "/" и "dir/" — index.html.
+    """
+
+    def __init__(self, directory: str, max_age: int = STATIC_MAX_AGE):
+        self.asset_cache_control = f"public, max-age={max_age}, stale-while-revalidate=86400".encode()
+        self.files: dict[str, StaticFile] = {}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    self.files[rel] = self._prepare(rel, f.read())
+
+    def _prepare(self, name: str, raw: bytes) -> StaticFile:
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        cache_control = b"no-cache" if content_type == "text/html" else self.asset_cache_control
+        if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+            content_type += "; charset=utf-8"
+        digest = hashlib.sha256(raw).hexdigest()[:20]
+        file = StaticFile(content_type, cache_control)
+        file.variants[""] = (f'"{digest}"'.encode(), raw)
+        if not content_type.startswith(_INCOMPRESSIBLE):
+            # mtime=0 — одинаковый результат при каждом старте
+            gz = gzip.compress(raw, compresslevel=9, mtime=0)
+            if len(gz) < len(raw):
+                file.variants["gzip"] = (f'"{digest}-gz"'.encode(), gz)
+            if brotli is not None:
+                br = brotli.compress(raw, quality=11)
+                if len(br) < len(raw):
+                    file.variants["br"] = (f'"{digest}-br"'.encode(), br)
+        return file
+
+    def _lookup(self, path: str) -> Optional[StaticFile]:
+        path = path.lstrip("/")
+        if path == "" or path.endswith("/"):
+            path += "index.html"
+        return self.files.get(path)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if scope["method"] not in ("GET", "HEAD"):
+            return await _send_bytes(send, 405, [(b"allow", b"GET, HEAD")])
+        file = self._lookup(scope["path"])
+        if file is None:
+            return await _send_bytes(send, 404, [(b"content-type", b"text/plain; charset=utf-8")], b"Not Found")
+
+        accepted = accepted_encodings(scope["headers"])
+        encoding = next((e for e in ("br", "gzip") if e in file.variants and e in accepted), "")
+        etag, body = file.variants[encoding]
+        headers = [
+            (b"etag", etag),
+            (b"cache-control", file.cache_control),
+            (b"vary", b"Accept-Encoding"),
+        ]
+
+        if_none_match = _header(scope["headers"], b"if-none-match")
+        if if_none_match is not None:
+            tags = {t.strip() for t in if_none_match.split(b",")}
+            if b"*" in tags or any(tag in tags for tag, _ in file.variants.values()):
+                return await _send_bytes(send, 304, headers)
+
+        headers += [
+            (b"content-type", file.content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+        ]
+        if encoding:
+            headers.append((b"content-encoding", encoding.encode()))
+        await _send_bytes(send, 200, headers, b"" if scope["method"] == "HEAD" else body)
+
+
+# ─── Сжатие ответов API ──────────────────────────────────────
+
+class CompressionMiddleware:
+    """
+    gzip для ответов по префиксам путей. Короткие ответы (целиком меньше
+    minimum_size) и уже сжатые проходят как есть; потоковые сжимаются
+    по мере отправки.
+    """
+
+    def __init__(self, app, prefixes: tuple = ("/api/",), minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.prefixes = prefixes
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not scope["path"].startswith(self.prefixes)
+                or "gzip" not in accepted_encodings(scope["headers"])):
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                headers = message.get("headers", [])
+                content_type = (_header(headers, b"content-type") or b"").decode("latin-1")
+                passthrough = (
+                    _header(headers, b"content-encoding") is not None
+                    or content_type.startswith(_INCOMPRESSIBLE)
+                    or message["status"] in (204, 304)
+                )
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                response_start, start = start, None
+                if passthrough or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(response_start)
+                    return await send(message)
+                headers = [(k, v) for k, v in response_start.get("headers", []) if k != b"content-length"]
+                headers += [(b"content-encoding", b"gzip"), (b"vary", b"Accept-Encoding")]
+                compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+                if not more_body:
+                    data = compressor.compress(body) + compressor.flush()
+                    headers.append((b"content-length", str(len(data)).encode()))
+                    await send({**response_start, "headers": headers})
+                    return await send({"type": "http.response.body", "body": data})
+                await send({**response_start, "headers": headers})
+            if passthrough:
+                return await send(message)
+
+            data = compressor.compress(body)
+            if more_body:
+                # Отдаём накопленное, чтобы поток не застревал в буфере zlib
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            else:
+                data += compressor.flush()
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
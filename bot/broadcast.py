@@ -0,0 +1,180 @@
+"""
+Рассылка всем представителям (/broadcast, POST /api/admin/broadcast).
+
+Задание и получатели хранятся в БД (broadcasts, broadcast_recipients).
+Фоновая задача шлёт до BROADCAST_CONCURRENCY сообщений параллельно под
+общим лимитом исходящих (notifier.limiter): получатель переводится
+pending → sending прямо перед своей отправкой и отмечается sent / failed
+сразу после неё.
+Прогресс раз в несколько секунд обновляется в сообщении администратора.
+
+После рестарта незаконченные рассылки продолжаются с pending-получателей.
+Зависшие в sending (процесс упал в момент отправки) помечаются failed, а не
+отправляются заново — получатель не увидит сообщение дважды. 429 и
+остановка процесса возвращают получателя в pending: сообщение точно не ушло.
+"""
+import asyncio
+import logging
+import os
+from datetime import timedelta
+from typing import Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from db.models import AsyncSessionLocal
+from db import crud
+from bot.notifier import limiter
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "5"))
+PROGRESS_INTERVAL = 3       # сек между обновлениями сообщения с прогрессом
+POLL_INTERVAL = 30          # сек — подстраховка, если notify() не вызвали
+STALE_AFTER = timedelta(minutes=5)
+SHUTDOWN_TIMEOUT = 10
+
+_bot: Optional[Bot] = None
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+_stopping = False
+
+
+def notify():
+    """Разбудить исполнителя после создания рассылки"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def progress_text(broadcast_id: int, counts: dict[str, int], finished: bool = False) -> str:
+    total = sum(counts.values())
+    sent, failed = counts.get("sent", 0), counts.get("failed", 0)
+    text = f"📣 Рассылка #{broadcast_id}: отправлено {sent} из {total}"
+    if failed:
+        text += f", не доставлено {failed}"
+    return text + (" — завершена ✅" if finished else "…")
+
+
+async def _report(broadcast_id: int, finished: bool = False):
+    async with AsyncSessionLocal() as db:
+        broadcast = await crud.get_broadcast(db, broadcast_id)
+        counts = await crud.broadcast_progress(db, broadcast_id)
+    if broadcast is None or broadcast.progress_chat_id is None:
+        return
+    try:
+        await _bot.edit_message_text(
+            progress_text(broadcast_id, counts, finished),
+            chat_id=broadcast.progress_chat_id, message_id=broadcast.progress_message_id,
+        )
+    except TelegramBadRequest:
+        pass        # «message is not modified» или сообщение удалено
+    except Exception as e:
+        logger.info("Прогресс рассылки #%d не обновлён: %s", broadcast_id, e)
+
+
+async def _send_next(broadcast_id: int, text: str) -> bool:
+    """
+    Забрать одного получателя прямо перед отправкой и отправить.
+    False — pending-получателей не осталось или процесс останавливается.
+    """
+    await limiter.take()
+    if _stopping:
+        return False
+    async with AsyncSessionLocal() as db:
+        claimed = await crud.claim_broadcast_recipients(db, broadcast_id, 1)
+    if not claimed:
+        return False
+    recipient_id, telegram_id = claimed[0]
+    status, error = "sent", None
+    while True:
+        try:
+            await _bot.send_message(telegram_id, text)
+        except TelegramRetryAfter as e:
+            limiter.pause(e.retry_after)
+            if _stopping:
+                async with AsyncSessionLocal() as db:
+                    await crud.release_broadcast_recipient(db, recipient_id)
+                return False
+            await limiter.take()
+            continue            # 429 — сообщение не принято, повтор безопасен
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            status, error = "failed", str(e)
+        except Exception as e:
+            # Сеть/таймаут: могло и дойти — не повторяем, чтобы не задвоить
+            status, error = "failed", str(e)
+        break
+    async with AsyncSessionLocal() as db:
+        await crud.finish_broadcast_recipient(db, recipient_id, status, error)
+    return True
+
+
+async def _worker(broadcast_id: int, text: str):
+    while await _send_next(broadcast_id, text):
+        pass
+
+
+async def _execute(broadcast_id: int, text: str):
+    # В sending одновременно не больше CONCURRENCY получателей — при падении
+    # процесса failed помечаются только те, кому отправка действительно шла
+    workers = {asyncio.create_task(_worker(broadcast_id, text)) for _ in range(CONCURRENCY)}
+    try:
+        while workers:
+            done, workers = await asyncio.wait(workers, timeout=PROGRESS_INTERVAL)
+            for task in done:
+                task.result()
+            if workers:
+                await _report(broadcast_id)
+    finally:
+        for task in workers:
+            task.cancel()
+    if _stopping:
+        return
+    async with AsyncSessionLocal() as db:
+        finished = await crud.complete_broadcast(db, broadcast_id)
+    # Не завершена — хвост ещё отправляет другой процесс, он и закроет
+    if finished:
+        logger.info("Рассылка #%d завершена", broadcast_id)
+        await _report(broadcast_id, finished=True)
+
+
+async def _run():
+    while True:
+        _wakeup.clear()
+        try:
+            async with AsyncSessionLocal() as db:
+                stale = await crud.fail_stale_broadcast_recipients(db, STALE_AFTER)
+                if stale:
+                    logger.warning("Рассылки: %d получателей с неподтверждённой доставкой помечены failed", stale)
+                broadcasts = await crud.get_pending_broadcasts(db)
+            for broadcast in broadcasts:
+                if _stopping:
+                    return
+                await _execute(broadcast.id, broadcast.text)
+        except Exception:
+            logger.exception("Рассылки: ошибка обработки")
+        if _stopping:
+            return
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start(bot: Bot):
+    global _bot, _wakeup, _task, _stopping
+    _bot = bot
+    _stopping = False
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    """Остановить после текущих отправок; незанятые получатели останутся pending"""
+    global _task, _stopping
+    if _task is None:
+        return
+    _stopping = True
+    notify()
+    try:
+        await asyncio.wait_for(_task, timeout=SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Рассылка не остановилась вовремя — продолжится после рестарта")
+    _task = None
@@ -1,15 +1,53 @@
 from aiogram import Router, F
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
+from datetime import datetime, timedelta
+from html import escape
 from sqlalchemy.ext.asyncio import AsyncSession
-from db import crud
+from db import crud, catalog
+from db.catalog import LOW_STOCK
+from bot import broadcast
 import os
 
 router = Router()
 
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
+
+
 def is_admin(user_id: int) -> bool:
-    admin_ids = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
-    return user_id in admin_ids
+    return user_id in ADMIN_IDS
+
+
+PRODUCTS_PAGE = 15
+ORDERS_PAGE = 10
+
+PRODUCT_FILTERS = {"all": None, "low": LOW_STOCK, "out": 1}
+PRODUCT_FILTER_TITLES = {"all": "", "low": f" (остаток < {LOW_STOCK})", "out": " (нет в наличии)"}
+ORDER_STATUSES = ("new", "processing", "done", "cancelled")
+_EPOCH = datetime(1970, 1, 1)
+
+
+def pager(prefix: str, prev_anchor: str = None, next_anchor: str = None):
+    """Кнопки ◀️ / ▶️; anchor попадает в callback_data (лимит Telegram — 64 байта)"""
+    buttons = []
+    if prev_anchor:
+        buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"{prefix}:p:{prev_anchor}"))
+    if next_anchor:
+        buttons.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=f"{prefix}:n:{next_anchor}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+async def show_page(target, text: str, keyboard):
+    """Новое сообщение для команды, правка на месте для кнопок"""
+    if isinstance(target, CallbackQuery):
+        try:
+            await target.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+        except TelegramBadRequest:
+            pass            # «message is not modified» — повторное нажатие
+        await target.answer()
+    else:
+        await target.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
 # ─── /addproduct Название | Описание | единица | остаток ────────────────────
@@ -27,6 +65,7 @@ async def cmd_add_product(message: Message, db: AsyncSession):
         stock = int(parts[3].strip()) if len(parts) > 3 else 0
         
         product = await crud.create_product(db, cmd_name, description, unit, stock)
+        catalog.invalidate()
         await message.answer(
             f"✅ Препарат добавлен:\n"
             f"ID: <b>{product.id}</b>\n"
@@ -48,6 +87,7 @@ async def cmd_set_stock(message: Message, db: AsyncSession):
     try:
         _, product_id, amount = message.text.split()
         product = await crud.update_stock(db, int(product_id), int(amount))
+        catalog.invalidate()
         await message.answer(f"✅ <b>{product.name}</b> — остаток установлен: {product.stock} {product.unit}", parse_mode="HTML")
     except:
         await message.answer("Формат: /setstock [id препарата] [количество]\nПример: /setstock 3 1500")
@@ -62,31 +102,112 @@ async def cmd_add_stock(message: Message, db: AsyncSession):
     try:
         _, product_id, amount = message.text.split()
         product = await crud.add_stock(db, int(product_id), int(amount))
+        catalog.invalidate()
         await message.answer(f"✅ <b>{product.name}</b> — добавлено {amount}, итого: {product.stock} {product.unit}", parse_mode="HTML")
     except:
         await message.answer("Формат: /addstock [id] [количество]\nПример: /addstock 3 500")
 
 
-# ─── /products — список всех препаратов ──────────────────────────────────────
-@router.message(Command("products"))
-async def cmd_products(message: Message, db: AsyncSession):
+# ─── /bulkstock — массовое изменение остатков ────────────────────────────────
+# /bulkstock
+# 3 1500     — установить остаток
+# 5 +200     — пополнить
+# 7 -10      — списать
+@router.message(Command("bulkstock"))
+async def cmd_bulk_stock(message: Message, db: AsyncSession):
     if not is_admin(message.from_user.id):
         return await message.answer("⛔ Нет доступа")
     
-    products = await crud.get_all_products(db)
+    absolute, delta, errors = {}, {}, []
+    for line in message.text.splitlines()[1:]:
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            product_id, amount = int(parts[0]), parts[1]
+            if product_id in absolute or product_id in delta:
+                raise ValueError
+            if amount[0] in "+-":
+                delta[product_id] = int(amount)
+            else:
+                absolute[product_id] = int(amount)
+        except (ValueError, IndexError):
+            errors.append(f"• «{escape(line.strip())}» — не разобрано")
+    
+    if not absolute and not delta:
+        return await message.answer(
+            "Формат (каждая позиция с новой строки):\n"
+            "/bulkstock\n3 1500 — установить остаток\n5 +200 — пополнить\n7 -10 — списать"
+        )
+    
+    outcome = await crud.bulk_adjust_stock(db, absolute, delta)
+    catalog.invalidate()
+    for product_id, (status, _) in outcome.items():
+        if status == "not_found":
+            errors.append(f"• ID {product_id} — не найден")
+        elif status == "insufficient":
+            errors.append(f"• ID {product_id} — остаток ушёл бы в минус")
+    
+    ok = sum(status == "ok" for status, _ in outcome.values())
+    text = f"✅ Обновлено позиций: <b>{ok}</b>"
+    if errors:
+        text += f"\n\n❌ Ошибки ({len(errors)}):\n" + "\n".join(errors[:30])
+        if len(errors) > 30:
+            text += f"\n… и ещё {len(errors) - 30}"
+    await message.answer(text, parse_mode="HTML")
+
+
+# ─── /products [low|out] — список препаратов постранично ────────────────────
+async def render_products(target, db: AsyncSession, flt: str, direction: str = None, anchor: int = None):
+    products, has_more = await crud.get_products_page(
+        db, limit=PRODUCTS_PAGE,
+        after_id=anchor if direction == "n" else None,
+        before_id=anchor if direction == "p" else None,
+        stock_below=PRODUCT_FILTERS[flt],
+    )
     if not products:
-        return await message.answer("Препаратов пока нет. Добавьте через /addproduct")
+        if direction is None:
+            text = "Препаратов пока нет. Добавьте через /addproduct" if flt == "all" else "Таких препаратов нет"
+            return await target.answer(text)
+        return await target.answer("Больше нет")
     
-    text = "📋 <b>Список препаратов:</b>\n\n"
+    text = f"📋 <b>Препараты{PRODUCT_FILTER_TITLES[flt]}:</b>\n\n"
     for p in products:
         status = "✅" if p.stock > 0 else "❌"
-        text += f"{status} ID <code>{p.id}</code> | <b>{p.name}</b>\n"
-        text += f"   Остаток: {p.stock} {p.unit}"
+        text += f"{status} ID <code>{p.id}</code> | <b>{escape(p.name)}</b>\n"
+        text += f"   Остаток: {p.stock} {escape(p.unit or '')}"
         if p.limit_per_order:
             text += f" | Лимит/заявка: {p.limit_per_order}"
         text += "\n\n"
     
-    await message.answer(text, parse_mode="HTML")
+    has_prev = has_more if direction == "p" else direction is not None
+    has_next = has_more if direction != "p" else True
+    keyboard = pager(
+        f"pp:{flt}",
+        prev_anchor=str(products[0].id) if has_prev else None,
+        next_anchor=str(products[-1].id) if has_next else None,
+    )
+    await show_page(target, text, keyboard)
+
+
+@router.message(Command("products"))
+async def cmd_products(message: Message, db: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔ Нет доступа")
+    
+    args = message.text.split()[1:]
+    flt = args[0].lower() if args else "all"
+    if flt not in PRODUCT_FILTERS:
+        return await message.answer("Формат: /products [low|out]")
+    await render_products(message, db, flt)
+
+
+@router.callback_query(F.data.startswith("pp:"))
+async def cb_products_page(callback: CallbackQuery, db: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer("⛔ Нет доступа")
+    _, flt, direction, anchor = callback.data.split(":")
+    await render_products(callback, db, flt, direction, int(anchor))
 
 
 # ─── /setlimit 5 200 — лимит на одну заявку ──────────────────────────────────
@@ -97,36 +218,90 @@ async def cmd_set_limit(message: Message, db: AsyncSession):
     
     try:
         _, product_id, limit = message.text.split()
-        from sqlalchemy import update
-        from db.models import Product, AsyncSessionLocal
-        async with AsyncSessionLocal() as s:
-            await s.execute(update(Product).where(Product.id == int(product_id)).values(limit_per_order=int(limit)))
-            await s.commit()
-        product = await crud.get_product(db, int(product_id))
+        product = await crud.set_limit(db, int(product_id), int(limit))
+        catalog.invalidate()
         await message.answer(f"✅ Лимит для <b>{product.name}</b> установлен: {limit} {product.unit} за 1 заявку", parse_mode="HTML")
     except:
         await message.answer("Формат: /setlimit [id] [лимит]\nПример: /setlimit 3 200")
 
 
-# ─── /orders — последние заявки ──────────────────────────────────────────────
-@router.message(Command("orders"))
-async def cmd_orders(message: Message, db: AsyncSession):
-    if not is_admin(message.from_user.id):
-        return await message.answer("⛔ Нет доступа")
-    
-    orders = await crud.get_orders(db, limit=10)
+# ─── /orders [статус] — заявки постранично ──────────────────────────────────
+def order_anchor(order) -> str:
+    micros = (order.created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}:{order.id}"
+
+
+def parse_order_anchor(micros: str, order_id: str) -> tuple[datetime, int]:
+    return _EPOCH + timedelta(microseconds=int(micros)), int(order_id)
+
+
+async def render_orders(target, db: AsyncSession, status: str = None, direction: str = None, anchor=None):
+    orders, has_more = await crud.get_orders_page(
+        db, limit=ORDERS_PAGE, status=status, with_items=False,
+        after=anchor if direction == "n" else None,
+        before=anchor if direction == "p" else None,
+    )
     if not orders:
-        return await message.answer("Заявок пока нет")
+        if direction is None:
+            return await target.answer("Заявок пока нет" if not status else f"Заявок со статусом «{status}» нет")
+        return await target.answer("Больше нет")
     
-    text = "📦 <b>Последние 10 заявок:</b>\n\n"
+    text = f"📦 <b>Заявки{f' ({status})' if status else ''}:</b>\n\n"
     for o in orders:
         text += (
             f"<b>#{o.id}</b> | {o.created_at.strftime('%d.%m %H:%M')}\n"
-            f"👤 {o.full_name} | 🏥 {o.institution}\n"
+            f"👤 {escape(o.full_name)} | 🏥 {escape(o.institution)}\n"
             f"📊 Позиций: {o.total_items} | Статус: {o.status}\n\n"
         )
     
-    await message.answer(text, parse_mode="HTML")
+    has_prev = has_more if direction == "p" else direction is not None
+    has_next = has_more if direction != "p" else True
+    keyboard = pager(
+        f"op:{status or '-'}",
+        prev_anchor=order_anchor(orders[0]) if has_prev else None,
+        next_anchor=order_anchor(orders[-1]) if has_next else None,
+    )
+    await show_page(target, text, keyboard)
+
+
+@router.message(Command("orders"))
+async def cmd_orders(message: Message, db: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔ Нет доступа")
+    
+    args = message.text.split()[1:]
+    status = args[0].lower() if args else None
+    if status and status not in ORDER_STATUSES:
+        return await message.answer(f"Формат: /orders [{'|'.join(ORDER_STATUSES)}]")
+    await render_orders(message, db, status)
+
+
+@router.callback_query(F.data.startswith("op:"))
+async def cb_orders_page(callback: CallbackQuery, db: AsyncSession):
+    if not is_admin(callback.from_user.id):
+        return await callback.answer("⛔ Нет доступа")
+    _, status, direction, micros, order_id = callback.data.split(":")
+    await render_orders(callback, db, None if status == "-" else status, direction,
+                        parse_order_anchor(micros, order_id))
+
+
+# ─── /broadcast Текст — рассылка всем представителям ─────────────────────────
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, db: AsyncSession):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔ Нет доступа")
+    
+    parts = message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        return await message.answer("Формат: /broadcast Текст сообщения\n(можно с новой строки, несколько абзацев)")
+    
+    job, total = await crud.create_broadcast(db, text, created_by=message.from_user.id)
+    broadcast.notify()
+    if not total:
+        return await message.answer("Активных представителей нет — рассылать некому")
+    progress = await message.answer(broadcast.progress_text(job.id, {"pending": total}))
+    await crud.set_broadcast_progress_message(db, job.id, progress.chat.id, progress.message_id)
 
 
 # ─── /help ───────────────────────────────────────────────────────────────────
@@ -137,11 +312,13 @@ async def cmd_admin_help(message: Message):
     
     await message.answer(
         "🔧 <b>Команды администратора:</b>\n\n"
-        "/products — список всех препаратов\n"
+        "/products [low|out] — препараты постранично\n"
         "/addproduct Название | Описание | шт | 1000 — добавить препарат\n"
         "/setstock [id] [кол-во] — установить остаток\n"
         "/addstock [id] [кол-во] — пополнить остаток\n"
+        "/bulkstock + список «id кол-во» / «id +кол-во» построчно — массово\n"
         "/setlimit [id] [лимит] — макс кол-во в 1 заявке\n"
-        "/orders — последние 10 заявок",
+        "/orders [new|processing|done|cancelled] — заявки постранично\n"
+        "/broadcast Текст — сообщение всем представителям",
         parse_mode="HTML"
     )
@@ -3,35 +3,39 @@ import logging
 import os
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import Update
 from fastapi import Request
-from db.models import AsyncSessionLocal
 
 load_dotenv()
 
+from bot.storage import create_storage     # после load_dotenv — модели читают DATABASE_URL
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Свой сервер Bot API (локальный telegram-bot-api или фейк для тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+
+def _session():
+    if not TELEGRAM_API_URL:
+        return None
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+
+
+bot = Bot(token=BOT_TOKEN, session=_session())
+dp = Dispatcher(storage=create_storage())
 
 
 async def setup_bot():
     from bot.handlers import user, admin
+    from bot.middlewares import DbMiddleware
     
-    # Middleware для инжекта БД в хэндлеры
-    from aiogram import BaseMiddleware
-    from typing import Callable, Dict, Any, Awaitable
-    
-    class DbMiddleware(BaseMiddleware):
-        async def __call__(self, handler: Callable, event: Any, data: Dict[str, Any]) -> Any:
-            async with AsyncSessionLocal() as session:
-                data["db"] = session
-                return await handler(event, data)
-    
-    dp.message.middleware(DbMiddleware())
+    # Ленивая сессия БД — одна на update, соединение только по требованию
+    dp.update.middleware(DbMiddleware())
     dp.include_router(user.router)
     dp.include_router(admin.router)
 
@@ -39,6 +43,10 @@ async def setup_bot():
 async def start_polling():
     """Запуск в режиме polling (для локальной разработки)"""
     await setup_bot()
+    # Сервер webhook при остановке его не снимает, а с активным webhook polling не работает
+    await bot.delete_webhook()
+    from bot import broadcast
+    broadcast.start(bot)     # незаконченные рассылки продолжатся и в polling-режиме
     logger.info("Bot started (polling mode)")
     await dp.start_polling(bot)
 
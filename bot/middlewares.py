@@ -0,0 +1,41 @@
+from typing import Any, Awaitable, Callable, Dict, Optional
+from aiogram import BaseMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import AsyncSessionLocal
+
+
+class LazySession:
+    """
+    Прокси к AsyncSession: сессия открывается только при первом обращении.
+    /start, /help и отказы в доступе обходятся без соединения с БД.
+    """
+
+    def __init__(self):
+        self._session: Optional[AsyncSession] = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str):
+        if self._session is None:
+            self._session = AsyncSessionLocal()
+        return getattr(self._session, name)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class DbMiddleware(BaseMiddleware):
+    """Одна ленивая сессия на update — её получают все хэндлеры как `db`"""
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        session = LazySession()
+        data["db"] = session
+        try:
+            return await handler(event, data)
+        finally:
+            await session.close()
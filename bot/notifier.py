@@ -0,0 +1,285 @@
+"""
+Исходящие уведомления в Telegram: новые заявки, смена статуса, низкие остатки.
+
+send() только кладёт текст в очередь чата и сразу возвращается — HTTP-запрос
+не ждёт Bot API. Отправкой занимается одна фоновая задача:
+- общий для всех исходящих сообщений процесса лимит NOTIFY_RATE в секунду
+  (limiter, им же пользуется рассылка) и не чаще одного сообщения в
+  NOTIFY_CHAT_INTERVAL секунд в один чат;
+- сообщения, накопившиеся в чате за NOTIFY_DIGEST_WINDOW секунд, уходят
+  одним дайджестом;
+- 429 — пауза на retry_after из ответа и повтор; заблокировавший бота
+  пользователь пропускается.
+
+Очередь в памяти процесса: при рестарте неотправленное теряется, при
+нескольких воркерах лимиты считаются в каждом отдельно (429 всё равно
+обрабатывается). Для проверки без настоящего Telegram бот можно направить
+на локальный сервер Bot API через TELEGRAM_API_URL (bot/main.py).
+"""
+import asyncio
+import logging
+import os
+import time
+from html import escape
+from typing import Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+MAX_ATTEMPTS = 3
+
+SENT = metrics.register(metrics.Counter("notify_sent_total", "Отправлено уведомлений (сообщений Telegram)"))
+RETRY_AFTER = metrics.register(metrics.Counter("notify_retry_after_total", "Ответов 429 от Bot API"))
+DROPPED = metrics.register(metrics.Counter("notify_dropped_total", "Уведомлений отброшено", ("reason",)))
+
+STATUS_TITLES = {"new": "Новая", "processing": "В работе", "done": "Выполнена", "cancelled": "Отменена"}
+
+
+class RateLimiter:
+    """Token bucket с общей паузой после 429"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+limiter = RateLimiter(float(os.getenv("NOTIFY_RATE", "30")))
+
+
+def _cut(line: str, limit: int) -> list[str]:
+    """Слишком длинную строку — на части, не разрезая тег или &сущность;"""
+    pieces = []
+    while len(line) > limit:
+        cut = limit
+        for opening, closing in (("&", ";"), ("<", ">")):
+            start = line.rfind(opening, 0, cut)
+            if start > 0 and line.find(closing, start, cut) == -1:
+                cut = start
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+
+def _chunks(text: str, limit: int) -> list[str]:
+    """Текст — на куски не длиннее limit по границам строк (теги в текстах не переходят через строку)"""
+    chunks, current = [], None
+    for line in text.split("\n"):
+        for piece in _cut(line, limit):
+            if current is not None and len(current) + 1 + len(piece) > limit:
+                chunks.append(current)
+                current = None
+            current = piece if current is None else f"{current}\n{piece}"
+    chunks.append(current or "")
+    return chunks
+
+
+def _split(texts: list[str]) -> list[str]:
+    """Склеить тексты в сообщения не длиннее лимита Telegram"""
+    if len(texts) == 1:
+        return _chunks(texts[0], MESSAGE_LIMIT)
+    messages, current = [], f"📬 Уведомлений: {len(texts)}"
+    for text in texts:
+        for chunk in _chunks(text, MESSAGE_LIMIT):
+            if len(current) + 2 + len(chunk) > MESSAGE_LIMIT:
+                messages.append(current)
+                current = chunk
+            else:
+                current += "\n\n" + chunk
+    messages.append(current)
+    return messages
+
+
+class Notifier:
+    def __init__(self, bot: Bot, limiter: RateLimiter, chat_interval: float = 1.0,
+                 digest_window: float = 2.0, max_pending: int = 10000):
+        self.bot = bot
+        self.limiter = limiter
+        self.chat_interval = chat_interval
+        self.digest_window = digest_window
+        self.max_pending = max_pending
+        self._pending: dict[int, list[str]] = {}     # чат → тексты
+        self._ready_at: dict[int, float] = {}        # чат → когда можно отправлять
+        self._attempts: dict[int, int] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    # ─── приём ───────────────────────────────────────────────
+
+    def send(self, chat_id: int, text: str):
+        if self._task is None:
+            return
+        if sum(map(len, self._pending.values())) >= self.max_pending:
+            DROPPED.inc("overflow")
+            return
+        texts = self._pending.setdefault(chat_id, [])
+        if not texts:
+            # Первое сообщение пачки ждёт окно дайджеста, но не раньше лимита чата
+            now = time.monotonic()
+            self._ready_at[chat_id] = max(self._ready_at.get(chat_id, 0.0), now + self.digest_window)
+        texts.append(text)
+        self._wakeup.set()
+
+    def pending(self) -> int:
+        return sum(map(len, self._pending.values()))
+
+    # ─── отправка ────────────────────────────────────────────
+
+    async def _deliver(self, chat_id: int, texts: list[str]):
+        messages = _split(texts)
+        for index, message in enumerate(messages):
+            await self.limiter.take()
+            try:
+                await self.bot.send_message(chat_id, message, parse_mode="HTML")
+            except TelegramRetryAfter as e:
+                RETRY_AFTER.inc()
+                # Неотправленный остаток — обратно в начало очереди чата
+                self._requeue(chat_id, messages[index:], delay=e.retry_after)
+                self.limiter.pause(e.retry_after)
+                return
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                DROPPED.inc("rejected")
+                logger.info("Уведомление в чат %s не доставлено: %s", chat_id, e)
+                return
+            except Exception as e:
+                attempts = self._attempts.get(chat_id, 0) + 1
+                if attempts >= MAX_ATTEMPTS:
+                    DROPPED.inc("error")
+                    self._attempts.pop(chat_id, None)
+                    logger.warning("Уведомление в чат %s отброшено после %d попыток: %s", chat_id, attempts, e)
+                    return
+                self._attempts[chat_id] = attempts
+                self._requeue(chat_id, messages[index:], delay=2 ** attempts)
+                return
+            SENT.inc()
+        self._attempts.pop(chat_id, None)
+
+    def _requeue(self, chat_id: int, messages: list[str], delay: float):
+        self._pending[chat_id] = messages + self._pending.get(chat_id, [])
+        self._ready_at[chat_id] = time.monotonic() + delay
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            ready = [c for c in self._pending if self._stopping or self._ready_at.get(c, 0.0) <= now]
+            for chat_id in ready:
+                texts = self._pending.pop(chat_id)
+                self._ready_at[chat_id] = time.monotonic() + self.chat_interval
+                await self._deliver(chat_id, texts)
+            if self._stopping and not self._pending:
+                return
+            if ready:
+                continue
+            timeout = min((self._ready_at[c] for c in self._pending), default=now + 60) - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0.01))
+            except asyncio.TimeoutError:
+                pass
+            # Старые записи о лимите чатов больше не нужны
+            if len(self._ready_at) > 10000:
+                now = time.monotonic()
+                self._ready_at = {c: t for c, t in self._ready_at.items() if t > now or c in self._pending}
+
+    def start(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Дослать накопленное без окна дайджеста и остановиться"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено уведомлений: %d", self.pending())
+        self._task = None
+
+
+def from_env(bot: Bot) -> Notifier:
+    return Notifier(
+        bot,
+        limiter,
+        chat_interval=float(os.getenv("NOTIFY_CHAT_INTERVAL", "1")),
+        digest_window=float(os.getenv("NOTIFY_DIGEST_WINDOW", "2")),
+    )
+
+
+# ─── Очередь процесса ────────────────────────────────────────
+
+_notifier: Optional[Notifier] = None
+
+
+def start(bot: Bot):
+    global _notifier
+    _notifier = from_env(bot)
+    _notifier.start()
+
+
+async def stop():
+    if _notifier is not None:
+        await _notifier.stop()
+
+
+def pending() -> int:
+    return _notifier.pending() if _notifier else 0
+
+
+def _send(chat_ids, text: str):
+    if _notifier is None:
+        return
+    for chat_id in dict.fromkeys(chat_ids):
+        _notifier.send(chat_id, text)
+
+
+# ─── Тексты уведомлений ──────────────────────────────────────
+
+def _admin_ids():
+    from bot.handlers.admin import ADMIN_IDS
+    return ADMIN_IDS
+
+
+def order_created(order_id: int, telegram_id: int, rep_code: str, full_name: str, institution: str,
+                  items: list[dict], payment_amount: float, payment_percent: int):
+    lines = "\n".join(f"• {escape(i['product_name'])}: {i['quantity']} {escape(i.get('unit', 'шт'))}" for i in items)
+    body = (f"🏥 {escape(institution)}\n{lines}\n"
+            f"💰 К оплате: {payment_amount:.2f} ({payment_percent}%)")
+    _send(_admin_ids(), f"🆕 <b>Заявка #{order_id}</b> — {escape(rep_code)} {escape(full_name)}\n{body}")
+    _send([telegram_id], f"✅ <b>Заявка #{order_id} принята</b>\n{body}")
+
+
+def status_changed(order_id: int, telegram_id: int, status: str):
+    _send([telegram_id], f"📦 Заявка #{order_id}: статус «{STATUS_TITLES.get(status, status)}»")
+
+
+def low_stock(products: list[tuple[str, int, str]]):
+    """products — (название, остаток, ед.) препаратов, только что опустившихся ниже порога"""
+    if not products:
+        return
+    lines = "\n".join(f"• {escape(name)}: {stock} {escape(unit)}" for name, stock, unit in products)
+    _send(_admin_ids(), f"⚠️ <b>Заканчиваются остатки</b>\n{lines}")
@@ -0,0 +1,79 @@
+"""
+Хранилище FSM aiogram.
+
+FSMContextMiddleware читает состояние на каждый update, поэтому по
+умолчанию хранилище в памяти: хэндлеры сейчас состояний не используют, и
+/start, /help и отказы чужим не должны ходить в БД. Общее для всех
+воркеров хранилище включается явно — когда появятся многошаговые диалоги.
+
+FSM_STORAGE:
+- memory (по умолчанию) — MemoryStorage, только для одного процесса;
+- db — таблица fsm_storage через общий движок SQLAlchemy;
+- redis — aiogram RedisStorage по REDIS_URL (любой сервер с протоколом
+  Redis; нужен пакет redis).
+"""
+import json
+import os
+from typing import Any, Dict, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from sqlalchemy import select, delete
+from db.models import AsyncSessionLocal, FsmRecord
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+class DbStorage(BaseStorage):
+    """Запись на ключ; пустое состояние без данных удаляется"""
+
+    async def _upsert(self, key: str, **values):
+        async with AsyncSessionLocal() as db:
+            dialect = db.bind.dialect.name
+            if dialect == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            stmt = dialect_insert(FsmRecord).values(key=key, **values)
+            await db.execute(stmt.on_conflict_do_update(index_elements=["key"], set_=values))
+            # Сброс FSM (state.clear()) не должен оставлять пустых строк
+            await db.execute(delete(FsmRecord).where(
+                FsmRecord.key == key, FsmRecord.state.is_(None), FsmRecord.data_json.is_(None),
+            ))
+            await db.commit()
+
+    async def _get(self, key: str) -> Optional[FsmRecord]:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(FsmRecord).where(FsmRecord.key == key))
+            return result.scalar_one_or_none()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._upsert(_key(key), state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get(_key(key))
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._upsert(_key(key), data_json=json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get(_key(key))
+        return json.loads(record.data_json) if record and record.data_json else {}
+
+    async def close(self) -> None:
+        pass
+
+
+def create_storage() -> BaseStorage:
+    backend = os.getenv("FSM_STORAGE", "memory")
+    if backend == "memory":
+        from aiogram.fsm.storage.memory import MemoryStorage
+        return MemoryStorage()
+    if backend == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "db":
+        return DbStorage()
+    raise ValueError(f"FSM_STORAGE: неизвестное хранилище {backend!r} (db, redis, memory)")
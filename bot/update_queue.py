@@ -0,0 +1,192 @@
+"""
+Очередь входящих update'ов для webhook-режима.
+
+Webhook сразу отвечает Telegram 200, а обработка идёт в пуле воркеров.
+Повторные доставки отсекаются по update_id: сначала скользящее окно
+последних id в памяти, затем общая для всех воркеров таблица
+processed_updates (повтор может прийти в другой процесс). Записи старше
+WEBHOOK_DEDUPE_HOURS часов удаляются.
+Если очередь заполнена — policy решает: "reject" (503, Telegram повторит
+доставку позже) или "drop_oldest" (вытесняем самый старый update).
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+from db.models import AsyncSessionLocal
+from db import crud
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+REJECTED = "rejected"
+
+DEDUPE_HOURS = float(os.getenv("WEBHOOK_DEDUPE_HOURS", "24"))
+PURGE_INTERVAL = 3600
+
+_last_purge = 0.0
+
+
+async def claim_shared(update_id: int) -> bool:
+    """Занять update_id в общей таблице; False — его уже принял другой воркер"""
+    global _last_purge
+    async with AsyncSessionLocal() as db:
+        if time.monotonic() - _last_purge >= PURGE_INTERVAL:
+            _last_purge = time.monotonic()
+            await crud.purge_processed_updates(db, datetime.utcnow() - timedelta(hours=DEDUPE_HOURS))
+        return await crud.claim_update(db, update_id)
+
+
+async def release_shared(update_id: int):
+    async with AsyncSessionLocal() as db:
+        await crud.release_update(db, update_id)
+
+
+class UpdateQueue:
+    def __init__(self, handler: Callable[[dict], Awaitable], workers: int = 4, maxsize: int = 1000,
+                 dedupe_window: int = 10000, policy: str = "reject",
+                 claim: Optional[Callable[[int], Awaitable[bool]]] = None,
+                 release: Optional[Callable[[int], Awaitable]] = None):
+        if policy not in ("reject", "drop_oldest"):
+            raise ValueError(f"Неизвестная policy: {policy}")
+        self.handler = handler
+        self.claim = claim          # общая между процессами отметка update_id
+        self.release = release
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._seen: set[int] = set()
+        self._seen_order: deque = deque()
+        self._dedupe_window = dedupe_window
+        self._latencies: deque = deque(maxlen=1000)
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    # ─── dedupe ──────────────────────────────────────────────
+
+    def _remember(self, update_id: int) -> bool:
+        """False — такой update_id уже был"""
+        if update_id in self._seen:
+            return False
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > self._dedupe_window:
+            self._seen.discard(self._seen_order.popleft())
+        return True
+
+    def _forget(self, update_id: int):
+        self._seen.discard(update_id)
+
+    # ─── приём ───────────────────────────────────────────────
+
+    async def _claim(self, update_id: int) -> bool:
+        if self.claim is None:
+            return True
+        try:
+            return await self.claim(update_id)
+        except Exception:
+            # БД недоступна — лучше обработать возможный повтор, чем потерять update
+            logger.exception("Не удалось отметить update %s", update_id)
+            return True
+
+    async def _release(self, update_id: int):
+        if self.release is None:
+            return
+        try:
+            await self.release(update_id)
+        except Exception:
+            logger.exception("Не удалось снять отметку update %s", update_id)
+
+    async def submit(self, update: dict) -> str:
+        update_id = update.get("update_id")
+        if update_id is not None:
+            if not self._remember(update_id):
+                self.duplicates += 1
+                return DUPLICATE
+            if not await self._claim(update_id):
+                self.duplicates += 1
+                return DUPLICATE
+        if self._queue.full():
+            if self.policy == "reject":
+                self.rejected += 1
+                if update_id is not None:
+                    # пусть повторная доставка пройдёт
+                    self._forget(update_id)
+                    await self._release(update_id)
+                return REJECTED
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self.dropped += 1
+        self._queue.put_nowait((time.monotonic(), update))
+        return QUEUED
+
+    # ─── обработка ───────────────────────────────────────────
+
+    async def _worker(self):
+        while True:
+            enqueued_at, update = await self._queue.get()
+            try:
+                await self.handler(update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Ошибка обработки update %s", update.get("update_id"))
+            finally:
+                self._latencies.append(time.monotonic() - enqueued_at)
+                self._queue.task_done()
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Дождаться обработки уже принятых update'ов и остановить воркеры"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь update'ов не разобрана: осталось %d", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def pct(p: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1) if latencies else 0.0
+
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "queue_max": self.maxsize,
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": pct(1.0)},
+        }
+
+
+def from_env(handler: Callable[[dict], Awaitable]) -> UpdateQueue:
+    return UpdateQueue(
+        handler,
+        workers=int(os.getenv("WEBHOOK_WORKERS", "4")),
+        maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+        dedupe_window=int(os.getenv("WEBHOOK_DEDUPE_WINDOW", "10000")),
+        policy=os.getenv("WEBHOOK_QUEUE_POLICY", "reject"),
+        claim=claim_shared,
+        release=release_shared,
+    )
@@ -0,0 +1,138 @@
+"""
+Кэш каталога для Mini App.
+
+Каталог меняется только из админки и команд бота, а читается при каждом
+открытии Mini App. Держим в памяти готовый JSON и ETag, пересобираем
+после invalidate() и не реже раза в CATALOG_REFRESH_INTERVAL секунд.
+Другие воркеры узнают о сбросе через db/invalidation.py; ETag — хэш
+содержимого, поэтому у всех процессов он одинаков.
+
+Заявка и её отмена (stock_changed) не перечитывают каталог: новые
+остатки из UPDATE ... RETURNING вписываются в снимок в памяти. Остальным
+процессам сообщается лишь о переходе остатка через порог — 0 или
+LOW_STOCK (тогда и свой снимок сбрасывается); точные числа у них
+обновятся при периодической пересборке.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+from .models import AsyncSessionLocal
+from . import crud, invalidation
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: int
+    etag: str
+    body: bytes
+    items: tuple          # те же словари, что в body — для поиска
+    built_at: float = 0.0     # time.monotonic()
+
+
+LOW_STOCK = 50      # порог «Осталось мало» в Mini App, админке и уведомлениях
+REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL", "30"))
+
+_version = 0
+_snapshot: Optional[CatalogSnapshot] = None
+_lock = asyncio.Lock()
+
+
+def _reset():
+    global _version, _snapshot
+    _version += 1
+    _snapshot = None
+
+
+def invalidate():
+    """Вызывать после любого изменения товаров или остатков (после commit)"""
+    _reset()
+    invalidation.publish("catalog")
+
+
+def _crossed(stock: int, change: int) -> bool:
+    """Остаток перешёл порог плашки: «Нет» (0) или «Осталось мало» (< LOW_STOCK)"""
+    before = stock - change
+    return any((before <= threshold) != (stock <= threshold) for threshold in (0, LOW_STOCK - 1))
+
+
+def stock_changed(remaining: dict[int, int], changes: dict[int, int]):
+    """
+    После списания по заявке или возврата при отмене (после commit):
+    remaining — остатки после UPDATE, changes — на сколько они изменились
+    (списание — отрицательное). Сменилась плашка препарата — сброс здесь
+    и в других процессах; иначе остатки вписываются в текущий снимок.
+    """
+    global _version
+    if _snapshot is None or any(_crossed(stock, changes[pid]) for pid, stock in remaining.items()):
+        invalidate()
+        return
+    items = tuple(
+        {**item, "stock": remaining[item["id"]], "available": remaining[item["id"]] > 0}
+        if item["id"] in remaining else item
+        for item in _snapshot.items
+    )
+    # Новая версия — и чтобы сборка, начатая до списания, не легла в кэш, и для поиска
+    _version += 1
+    _set(_build(_version, items, _snapshot.built_at))
+
+
+invalidation.subscribe("catalog", _reset)
+
+
+def _to_dicts(products) -> tuple:
+    return tuple(
+        {
+            "id": p.id,
+            "name": p.name,
+            "description": p.description,
+            "unit": p.unit,
+            "stock": p.stock,
+            "price": p.price,
+            "limit_per_order": p.limit_per_order,
+            "available": p.stock > 0,
+        }
+        for p in products
+    )
+
+
+def _build(version: int, items: tuple, built_at: float) -> CatalogSnapshot:
+    body = json.dumps(list(items), ensure_ascii=False).encode()
+    return CatalogSnapshot(
+        version=version,
+        etag='"%s"' % hashlib.sha1(body).hexdigest(),
+        body=body,
+        items=items,
+        built_at=built_at,
+    )
+
+
+def _fresh(snapshot: Optional[CatalogSnapshot]) -> bool:
+    return snapshot is not None and time.monotonic() - snapshot.built_at < REFRESH_INTERVAL
+
+
+async def get_snapshot() -> CatalogSnapshot:
+    snapshot = _snapshot
+    if _fresh(snapshot):
+        return snapshot
+    async with _lock:
+        if _fresh(_snapshot):
+            return _snapshot
+        if _snapshot is not None:
+            _reset()        # периодическая пересборка — новая версия и для поиска
+        version = _version
+        async with AsyncSessionLocal() as db:
+            products = await crud.get_all_products(db)
+        snapshot = _build(version, _to_dicts(products), time.monotonic())
+        # Если каталог поменялся, пока мы читали, — не кэшируем устаревший снимок
+        if version == _version:
+            _set(snapshot)
+        return snapshot
+
+
+def _set(snapshot: CatalogSnapshot):
+    global _snapshot
+    _snapshot = snapshot
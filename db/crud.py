@@ -1,7 +1,14 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
-from .models import Product, Order, Representative
+from sqlalchemy import select, update, insert, delete, case, and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from . import stats
+from .models import (
+    Product, Order, OrderItem, Representative, SheetOutbox, IdempotencyKey,
+    Broadcast, BroadcastRecipient, ProcessedUpdate,
+)
 from typing import Optional
+from datetime import datetime, timedelta
 import json
 
 
@@ -12,6 +19,29 @@ async def get_all_products(db: AsyncSession) -> list[Product]:
     return result.scalars().all()
 
 
+async def get_products_page(db: AsyncSession, limit: int = 15,
+                            after_id: Optional[int] = None, before_id: Optional[int] = None,
+                            stock_below: Optional[int] = None) -> tuple[list[Product], bool]:
+    """
+    Страница активных препаратов с keyset-пагинацией по id.
+    Возвращает (препараты, есть ли ещё в направлении листания).
+    """
+    query = select(Product).where(Product.is_active == True)
+    if stock_below is not None:
+        query = query.where(Product.stock < stock_below)
+    if before_id is not None:
+        query = query.where(Product.id < before_id).order_by(Product.id.desc())
+    else:
+        if after_id is not None:
+            query = query.where(Product.id > after_id)
+        query = query.order_by(Product.id)
+    products = (await db.execute(query.limit(limit + 1))).scalars().all()
+    page = products[:limit]
+    if before_id is not None:
+        page.reverse()
+    return page, len(products) > limit
+
+
 async def get_product(db: AsyncSession, product_id: int) -> Optional[Product]:
     result = await db.execute(select(Product).where(Product.id == product_id))
     return result.scalar_one_or_none()
@@ -32,6 +62,12 @@ async def update_stock(db: AsyncSession, product_id: int, new_stock: int) -> Opt
     return await get_product(db, product_id)
 
 
+async def set_limit(db: AsyncSession, product_id: int, limit: Optional[int]) -> Optional[Product]:
+    await db.execute(update(Product).where(Product.id == product_id).values(limit_per_order=limit))
+    await db.commit()
+    return await get_product(db, product_id)
+
+
 async def add_stock(db: AsyncSession, product_id: int, amount: int) -> Optional[Product]:
     product = await get_product(db, product_id)
     if product:
@@ -39,15 +75,121 @@ async def add_stock(db: AsyncSession, product_id: int, amount: int) -> Optional[
     return None
 
 
-async def deduct_stock(db: AsyncSession, items: list[dict]) -> bool:
-    for item in items:
-        product = await get_product(db, item["product_id"])
-        if not product or product.stock < item["quantity"]:
-            return False
+async def get_products_by_ids(db: AsyncSession, product_ids) -> dict[int, Product]:
+    """Все запрошенные препараты одним запросом IN (...)"""
+    ids = set(product_ids)
+    if not ids:
+        return {}
+    result = await db.execute(select(Product).where(Product.id.in_(ids)))
+    return {p.id: p for p in result.scalars().all()}
+
+
+async def deduct_stock(db: AsyncSession, items: list[dict]) -> Optional[dict[int, int]]:
+    """
+    Списание остатков одним условным UPDATE:
+    stock = stock - q WHERE id = :id AND stock >= q (через CASE по id).
+    Не коммитит — вызывающий код решает, фиксировать транзакцию или откатить.
+    Возвращает {id: остаток после списания} или None, если хотя бы
+    одной позиции не хватило.
+    """
+    wanted: dict[int, int] = {}
     for item in items:
-        product = await get_product(db, item["product_id"])
-        await update_stock(db, item["product_id"], product.stock - item["quantity"])
-    return True
+        wanted[item["product_id"]] = wanted.get(item["product_id"], 0) + item["quantity"]
+    if not wanted:
+        return {}
+    qty = case(wanted, value=Product.id)
+    result = await db.execute(
+        update(Product)
+        .where(Product.id.in_(wanted), Product.stock >= qty)
+        .values(stock=Product.stock - qty)
+        .returning(Product.id, Product.stock)
+        .execution_options(synchronize_session=False)
+    )
+    remaining = dict(result.all())
+    return remaining if len(remaining) == len(wanted) else None
+
+
+BULK_CHUNK = 150   # id на один запрос — с запасом под лимит параметров SQLite (999)
+
+PRODUCT_DEFAULTS = {"description": "", "unit": "шт", "stock": 0, "price": 0.0, "limit_per_order": None}
+
+
+async def bulk_upsert_products(db: AsyncSession, rows: list[dict]) -> dict[str, tuple[str, int]]:
+    """
+    Upsert препаратов по названию одной транзакцией.
+    rows — словари с name и любыми полями Product; при повторе названия
+    побеждает последняя строка. Возвращает {name: ("created"|"updated", id)}.
+    """
+    merged: dict[str, dict] = {}
+    for row in rows:
+        merged.setdefault(row["name"], {}).update(row)
+    names = list(merged)
+
+    existing: dict[str, int] = {}
+    for i in range(0, len(names), BULK_CHUNK):
+        result = await db.execute(
+            select(Product.id, Product.name).where(Product.name.in_(names[i:i + BULK_CHUNK])).order_by(Product.id)
+        )
+        for product_id, name in result.all():
+            existing.setdefault(name, product_id)
+
+    outcome: dict[str, tuple[str, int]] = {}
+    to_update = [{**fields, "id": existing[name]} for name, fields in merged.items() if name in existing]
+    to_insert = [{**PRODUCT_DEFAULTS, "is_active": True, **fields} for name, fields in merged.items() if name not in existing]
+
+    if to_update:
+        await db.execute(update(Product), to_update)
+        outcome.update({row["name"]: ("updated", row["id"]) for row in to_update})
+    if to_insert:
+        result = await db.execute(insert(Product).returning(Product.id, Product.name), to_insert)
+        outcome.update({name: ("created", product_id) for product_id, name in result.all()})
+    await db.commit()
+    return outcome
+
+
+async def bulk_adjust_stock(db: AsyncSession, absolute: dict[int, int], delta: dict[int, int]) -> dict[int, tuple[str, Optional[int]]]:
+    """
+    Массовое изменение остатков одной транзакцией:
+    absolute — {id: новый остаток}, delta — {id: +/- изменение}.
+    Изменение, уводящее остаток в минус, не применяется.
+    Возвращает {id: ("ok"|"not_found"|"insufficient", остаток)}.
+    """
+    ids = list(set(absolute) | set(delta))
+    found: set[int] = set()
+    for i in range(0, len(ids), BULK_CHUNK):
+        result = await db.execute(select(Product.id).where(Product.id.in_(ids[i:i + BULK_CHUNK])))
+        found.update(result.scalars().all())
+
+    outcome: dict[int, tuple[str, Optional[int]]] = {pid: ("not_found", None) for pid in ids if pid not in found}
+    absolute = {pid: v for pid, v in absolute.items() if pid in found}
+    delta = {pid: v for pid, v in delta.items() if pid in found}
+
+    absolute_ids, delta_ids = list(absolute), list(delta)
+    for i in range(0, len(absolute_ids), BULK_CHUNK):
+        chunk = {pid: absolute[pid] for pid in absolute_ids[i:i + BULK_CHUNK]}
+        result = await db.execute(
+            update(Product)
+            .where(Product.id.in_(chunk))
+            .values(stock=case(chunk, value=Product.id))
+            .returning(Product.id, Product.stock)
+            .execution_options(synchronize_session=False)
+        )
+        outcome.update({pid: ("ok", stock) for pid, stock in result.all()})
+    for i in range(0, len(delta_ids), BULK_CHUNK):
+        chunk = {pid: delta[pid] for pid in delta_ids[i:i + BULK_CHUNK]}
+        change = case(chunk, value=Product.id)
+        result = await db.execute(
+            update(Product)
+            .where(Product.id.in_(chunk), Product.stock + change >= 0)
+            .values(stock=Product.stock + change)
+            .returning(Product.id, Product.stock)
+            .execution_options(synchronize_session=False)
+        )
+        outcome.update({pid: ("ok", stock) for pid, stock in result.all()})
+    for pid in delta_ids:
+        outcome.setdefault(pid, ("insufficient", None))
+    await db.commit()
+    return outcome
 
 
 # ─── Representatives ─────────────────────────────────────────
@@ -75,8 +217,21 @@ async def create_rep(db: AsyncSession, code: str, telegram_id: int, full_name: s
     return rep
 
 
+async def update_rep(db: AsyncSession, rep_id: int, **values):
+    """Изменение представителя; version растёт — выданные токены Mini App отзываются"""
+    await db.execute(
+        update(Representative).where(Representative.id == rep_id)
+        .values(**values, version=Representative.version + 1)
+    )
+    await db.commit()
+
+
+async def get_rep_versions(db: AsyncSession) -> dict[int, int]:
+    result = await db.execute(select(Representative.id, Representative.version))
+    return dict(result.all())
+
+
 async def delete_rep(db: AsyncSession, rep_id: int):
-    from sqlalchemy import delete
     await db.execute(delete(Representative).where(Representative.id == rep_id))
     await db.commit()
 
@@ -87,6 +242,7 @@ async def create_order(db: AsyncSession, telegram_id: int, telegram_username: st
                         rep_code: str, full_name: str, institution: str,
                         items: list[dict], total_price: float,
                         payment_percent: int) -> Order:
+    """Добавляет заказ в текущую транзакцию (flush без commit)"""
     total_qty = sum(i["quantity"] for i in items)
     payment_amount = round(total_price * payment_percent / 100, 2)
     order = Order(
@@ -95,23 +251,517 @@ async def create_order(db: AsyncSession, telegram_id: int, telegram_username: st
         rep_code=rep_code,
         full_name=full_name,
         institution=institution,
-        items_json=json.dumps(items, ensure_ascii=False),
         total_items=total_qty,
         total_price=total_price,
         payment_percent=payment_percent,
         payment_amount=payment_amount,
+        items=[
+            OrderItem(
+                product_id=i["product_id"],
+                product_name=i["product_name"],
+                quantity=i["quantity"],
+                price=i["price"],
+                line_total=i["line_total"],
+                unit=i["unit"],
+            )
+            for i in items
+        ],
     )
     db.add(order)
-    await db.commit()
-    await db.refresh(order)
+    await db.flush()
+    await stats.record_order(db, order)
     return order
 
 
-async def get_orders(db: AsyncSession, limit: int = 100) -> list[Order]:
-    result = await db.execute(select(Order).order_by(Order.created_at.desc()).limit(limit))
+def order_filters(status: Optional[str] = None, rep_code: Optional[str] = None,
+                  institution: Optional[str] = None,
+                  created_from: Optional[datetime] = None,
+                  created_to: Optional[datetime] = None) -> list:
+    conditions = []
+    if status:
+        conditions.append(Order.status == status)
+    if rep_code:
+        conditions.append(Order.rep_code == rep_code)
+    if institution:
+        conditions.append(Order.institution.ilike(f"%{institution}%"))
+    if created_from:
+        conditions.append(Order.created_at >= created_from)
+    if created_to:
+        conditions.append(Order.created_at < created_to)
+    return conditions
+
+
+async def get_orders_page(db: AsyncSession, limit: int = 100,
+                          after: Optional[tuple[datetime, int]] = None,
+                          before: Optional[tuple[datetime, int]] = None,
+                          status: Optional[str] = None, rep_code: Optional[str] = None,
+                          institution: Optional[str] = None,
+                          created_from: Optional[datetime] = None,
+                          created_to: Optional[datetime] = None,
+                          with_items: bool = True) -> tuple[list[Order], bool]:
+    """
+    Страница заявок (новые сверху) с keyset-пагинацией по (created_at, id).
+    after — ключ последней заявки предыдущей страницы (листаем дальше),
+    before — ключ первой заявки текущей страницы (листаем назад).
+    Возвращает (заявки, есть ли ещё в направлении листания).
+    """
+    query = select(Order)
+    if with_items:
+        query = query.options(selectinload(Order.items))
+    if before is not None:
+        created_at, order_id = before
+        query = query.where(or_(
+            Order.created_at > created_at,
+            and_(Order.created_at == created_at, Order.id > order_id),
+        )).order_by(Order.created_at, Order.id)
+    else:
+        if after is not None:
+            created_at, order_id = after
+            query = query.where(or_(
+                Order.created_at < created_at,
+                and_(Order.created_at == created_at, Order.id < order_id),
+            ))
+        query = query.order_by(Order.created_at.desc(), Order.id.desc())
+    query = query.where(*order_filters(status, rep_code, institution, created_from, created_to))
+    orders = (await db.execute(query.limit(limit + 1))).scalars().all()
+    page = orders[:limit]
+    if before is not None:
+        page.reverse()
+    return page, len(orders) > limit
+
+
+async def stream_order_lines(db: AsyncSession, batch_size: int = 1000, **filters):
+    """
+    Позиции заявок для выгрузки (по строке на препарат), старые сверху.
+    Читает серверным курсором пачками по batch_size, отдаёт списки строк.
+    """
+    query = (
+        select(
+            Order.id, Order.created_at, Order.rep_code, Order.full_name, Order.telegram_username,
+            Order.institution, Order.status, Order.total_price, Order.payment_percent, Order.payment_amount,
+            OrderItem.product_name, OrderItem.quantity, OrderItem.unit, OrderItem.price, OrderItem.line_total,
+        )
+        .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+        .where(*order_filters(**filters))
+        .order_by(Order.created_at, Order.id, OrderItem.id)
+        .execution_options(yield_per=batch_size)
+    )
+    result = await db.stream(query)
+    async for partition in result.partitions():
+        yield partition
+
+
+# Разрешённые переходы: new → processing → done, отмена — из любого статуса
+ORDER_TRANSITIONS = {
+    "new": ("processing", "cancelled"),
+    "processing": ("done", "cancelled"),
+    "done": ("cancelled",),
+    "cancelled": (),
+}
+
+
+async def get_order_ids(db: AsyncSession, limit: int, **filters) -> list[int]:
+    """id заявок по фильтрам order_filters — для массовых операций"""
+    result = await db.execute(
+        select(Order.id).where(*order_filters(**filters)).order_by(Order.id).limit(limit)
+    )
+    return list(result.scalars().all())
+
+
+async def bulk_update_order_status(
+    db: AsyncSession, order_ids: list[int], status: str,
+) -> tuple[dict[int, tuple[str, Optional[str]]], dict[int, tuple[int, int]]]:
+    """
+    Массовая смена статуса по ORDER_TRANSITIONS одной транзакцией:
+    UPDATE ... WHERE id IN (...) AND status IN (допустимые исходные).
+    Отмена возвращает остатки и вычитает заявки из агрегатов продаж.
+    Возвращает ({id: (исход, статус до изменения)}, {id препарата:
+    (остаток после возврата, сколько возвращено)}), исход —
+    ok | unchanged | not_allowed | not_found | conflict.
+    """
+    sources = [s for s, targets in ORDER_TRANSITIONS.items() if status in targets]
+    ids = list(dict.fromkeys(order_ids))
+    previous: dict[int, str] = {}
+    for i in range(0, len(ids), BULK_CHUNK):
+        result = await db.execute(select(Order.id, Order.status).where(Order.id.in_(ids[i:i + BULK_CHUNK])))
+        previous.update(result.all())
+
+    outcome: dict[int, tuple[str, Optional[str]]] = {}
+    candidates = []
+    for order_id in ids:
+        current = previous.get(order_id)
+        if current is None:
+            outcome[order_id] = ("not_found", None)
+        elif current == status:
+            outcome[order_id] = ("unchanged", current)
+        elif current not in sources:
+            outcome[order_id] = ("not_allowed", current)
+        else:
+            candidates.append(order_id)
+
+    changed: list[int] = []
+    for i in range(0, len(candidates), BULK_CHUNK):
+        result = await db.execute(
+            update(Order)
+            .where(Order.id.in_(candidates[i:i + BULK_CHUNK]), Order.status.in_(sources))
+            .values(status=status)
+            .returning(Order.id)
+            .execution_options(synchronize_session=False)
+        )
+        changed.extend(result.scalars().all())
+    for order_id in changed:
+        outcome[order_id] = ("ok", previous[order_id])
+    for order_id in candidates:
+        # Статус успели поменять параллельно на недопустимый для перехода
+        outcome.setdefault(order_id, ("conflict", previous[order_id]))
+
+    restocked: dict[int, tuple[int, int]] = {}
+    if status == "cancelled" and changed:
+        orders = []
+        for i in range(0, len(changed), BULK_CHUNK):
+            result = await db.execute(
+                select(Order).options(selectinload(Order.items)).where(Order.id.in_(changed[i:i + BULK_CHUNK]))
+            )
+            orders.extend(result.scalars().all())
+        returned: dict[int, int] = {}
+        for order in orders:
+            for item in order.items:
+                returned[item.product_id] = returned.get(item.product_id, 0) + item.quantity
+        product_ids = list(returned)
+        for i in range(0, len(product_ids), BULK_CHUNK):
+            chunk = {pid: returned[pid] for pid in product_ids[i:i + BULK_CHUNK]}
+            result = await db.execute(
+                update(Product)
+                .where(Product.id.in_(chunk))
+                .values(stock=Product.stock + case(chunk, value=Product.id))
+                .returning(Product.id, Product.stock)
+                .execution_options(synchronize_session=False)
+            )
+            restocked.update((pid, (stock, chunk[pid])) for pid, stock in result.all())
+        await stats.revert_orders(db, orders)
+    return outcome, restocked
+
+
+async def get_order_owners(db: AsyncSession, order_ids: list[int]) -> dict[int, int]:
+    """{id заявки: telegram_id представителя}"""
+    owners: dict[int, int] = {}
+    for i in range(0, len(order_ids), BULK_CHUNK):
+        result = await db.execute(select(Order.id, Order.telegram_id).where(Order.id.in_(order_ids[i:i + BULK_CHUNK])))
+        owners.update(result.all())
+    return owners
+
+
+async def get_sheet_rows(db: AsyncSession, order_ids: list[int]) -> dict[int, int]:
+    """{id заявки: номер строки в таблице} для уже выгруженных заявок"""
+    rows: dict[int, int] = {}
+    for i in range(0, len(order_ids), BULK_CHUNK):
+        result = await db.execute(
+            select(Order.id, Order.sheets_row)
+            .where(Order.id.in_(order_ids[i:i + BULK_CHUNK]), Order.sheets_row.is_not(None))
+        )
+        rows.update(result.all())
+    return rows
+
+
+async def get_order_statuses(db: AsyncSession, order_ids: list[int]) -> dict[int, str]:
+    """{id заявки: текущий статус}"""
+    statuses: dict[int, str] = {}
+    for i in range(0, len(order_ids), BULK_CHUNK):
+        result = await db.execute(select(Order.id, Order.status).where(Order.id.in_(order_ids[i:i + BULK_CHUNK])))
+        statuses.update(result.all())
+    return statuses
+
+
+# ─── Google Sheets outbox ────────────────────────────────────
+
+async def enqueue_sheet_row(db: AsyncSession, order_id: int, row: list):
+    """Ставит строку в очередь выгрузки в текущей транзакции (без commit)"""
+    db.add(SheetOutbox(order_id=order_id, row_json=json.dumps(row, ensure_ascii=False)))
+
+
+async def next_sheet_attempt(db: AsyncSession) -> Optional[datetime]:
+    """Когда ближайшая строка очереди станет готова к отправке; None — очередь пуста"""
+    result = await db.execute(select(func.min(SheetOutbox.next_attempt_at)))
+    return result.scalar_one_or_none()
+
+
+async def claim_sheet_rows(db: AsyncSession, limit: int = 100, lease: int = 300) -> list[SheetOutbox]:
+    """
+    Забирает готовые к отправке строки: next_attempt_at сдвигается на lease
+    секунд условным UPDATE, так что параллельный воркер (другой процесс)
+    те же строки не получит. complete/fail_sheet_rows снимают аренду.
+    """
+    now = datetime.utcnow()
+    result = await db.execute(
+        select(SheetOutbox.id)
+        .where(SheetOutbox.next_attempt_at <= now)
+        .order_by(SheetOutbox.id)
+        .limit(limit)
+    )
+    ids = result.scalars().all()
+    if not ids:
+        return []
+    claimed = await db.execute(
+        update(SheetOutbox)
+        .where(SheetOutbox.id.in_(ids), SheetOutbox.next_attempt_at <= now)
+        .values(next_attempt_at=now + timedelta(seconds=lease))
+        .returning(SheetOutbox.id)
+        .execution_options(synchronize_session=False)
+    )
+    claimed_ids = claimed.scalars().all()
+    await db.commit()
+    if not claimed_ids:
+        return []
+    result = await db.execute(select(SheetOutbox).where(SheetOutbox.id.in_(claimed_ids)).order_by(SheetOutbox.id))
+    return result.scalars().all()
+
+
+async def complete_sheet_rows(db: AsyncSession, entries: list[SheetOutbox], first_row: Optional[int]):
+    """Удаляет выгруженные строки и проставляет Order.sheets_row по порядку"""
+    if first_row is not None:
+        rows = {e.order_id: first_row + offset for offset, e in enumerate(entries)}
+        await db.execute(
+            update(Order)
+            .where(Order.id.in_(rows))
+            .values(sheets_row=case(rows, value=Order.id))
+            .execution_options(synchronize_session=False)
+        )
+    await db.execute(delete(SheetOutbox).where(SheetOutbox.id.in_([e.id for e in entries])))
+    await db.commit()
+
+
+async def fail_sheet_rows(db: AsyncSession, entries: list[SheetOutbox], error: str, max_delay: int = 300):
+    """Откладывает повтор с экспоненциальной задержкой"""
+    now = datetime.utcnow()
+    for entry in entries:
+        attempts = (entry.attempts or 0) + 1
+        await db.execute(
+            update(SheetOutbox).where(SheetOutbox.id == entry.id).values(
+                attempts=attempts,
+                next_attempt_at=now + timedelta(seconds=min(2 ** attempts, max_delay)),
+                last_error=error[:1000],
+            )
+        )
+    await db.commit()
+
+
+# ─── Idempotency keys ────────────────────────────────────────
+
+async def claim_idempotency_key(db: AsyncSession, key: str, payload_hash: str, owner: str,
+                                stale_after: int = 60) -> Optional[IdempotencyKey]:
+    """
+    Пытается занять ключ (отдельной транзакцией) за запросом owner.
+    None — ключ наш, можно выполнять; иначе — существующая запись
+    (done — отдать сохранённый ответ, pending — заявка ещё обрабатывается;
+    payload_hash записи сверяет вызывающий).
+    Владелец продлевает аренду (renew_idempotency_key), пока выполняется;
+    pending без продления дольше stale_after секунд — процесс упал, ключ
+    занимается заново. Если упавший всё же очнётся, его заявку не даст
+    зафиксировать complete_idempotency_key — владелец уже другой.
+    """
+    db.add(IdempotencyKey(key=key, status="pending", payload_hash=payload_hash, owner=owner))
+    try:
+        await db.commit()
+        return None
+    except IntegrityError:
+        await db.rollback()
+    result = await db.execute(select(IdempotencyKey).where(IdempotencyKey.key == key))
+    existing = result.scalar_one_or_none()
+    if existing is None:
+        return await claim_idempotency_key(db, key, payload_hash, owner, stale_after)
+    if existing.status == "pending" and existing.created_at < datetime.utcnow() - timedelta(seconds=stale_after):
+        result = await db.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key, IdempotencyKey.status == "pending",
+                   IdempotencyKey.created_at == existing.created_at)
+            .values(created_at=datetime.utcnow(), payload_hash=payload_hash, owner=owner)
+        )
+        await db.commit()
+        if result.rowcount == 1:
+            return None
+    return existing
+
+
+async def renew_idempotency_key(db: AsyncSession, key: str, owner: str) -> bool:
+    """Продлить аренду pending-ключа; False — ключ уже не наш"""
+    result = await db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key, IdempotencyKey.owner == owner, IdempotencyKey.status == "pending")
+        .values(created_at=datetime.utcnow())
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def complete_idempotency_key(db: AsyncSession, key: str, owner: str, response: dict) -> bool:
+    """
+    Сохраняет ответ в текущей транзакции (коммитится вместе с заказом).
+    False — аренду перехватил другой запрос: заказ фиксировать нельзя.
+    """
+    result = await db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key, IdempotencyKey.owner == owner, IdempotencyKey.status == "pending")
+        .values(status="done", response_json=json.dumps(response, ensure_ascii=False))
+    )
+    return result.rowcount == 1
+
+
+async def release_idempotency_key(db: AsyncSession, key: str, owner: str):
+    await db.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.key == key, IdempotencyKey.owner == owner, IdempotencyKey.status == "pending",
+    ))
+    await db.commit()
+
+
+async def purge_idempotency_keys(db: AsyncSession, older_than: datetime) -> int:
+    result = await db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < older_than))
+    await db.commit()
+    return result.rowcount
+
+
+# ─── Webhook updates ─────────────────────────────────────────
+
+async def claim_update(db: AsyncSession, update_id: int) -> bool:
+    """Отметить update_id принятым (отдельной транзакцией). False — его уже принял какой-то воркер."""
+    db.add(ProcessedUpdate(update_id=update_id))
+    try:
+        await db.commit()
+        return True
+    except IntegrityError:
+        await db.rollback()
+        return False
+
+
+async def release_update(db: AsyncSession, update_id: int):
+    """Снять отметку — update не поставлен в очередь, повторная доставка должна пройти"""
+    await db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.update_id == update_id))
+    await db.commit()
+
+
+async def purge_processed_updates(db: AsyncSession, older_than: datetime) -> int:
+    result = await db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.created_at < older_than))
+    await db.commit()
+    return result.rowcount
+
+
+# ─── Broadcasts ──────────────────────────────────────────────
+
+async def create_broadcast(db: AsyncSession, text: str, created_by: Optional[int] = None) -> tuple[Broadcast, int]:
+    """Рассылка всем активным представителям. Возвращает (рассылка, число получателей)."""
+    broadcast = Broadcast(text=text, created_by=created_by)
+    db.add(broadcast)
+    await db.flush()
+    result = await db.execute(
+        select(Representative.telegram_id).where(Representative.is_active == True).distinct()
+    )
+    rows = [{"broadcast_id": broadcast.id, "telegram_id": tid, "status": "pending"} for tid in result.scalars().all()]
+    if rows:
+        await db.execute(insert(BroadcastRecipient), rows)
+    await db.commit()
+    return broadcast, len(rows)
+
+
+async def set_broadcast_progress_message(db: AsyncSession, broadcast_id: int, chat_id: int, message_id: int):
+    await db.execute(
+        update(Broadcast).where(Broadcast.id == broadcast_id)
+        .values(progress_chat_id=chat_id, progress_message_id=message_id)
+    )
+    await db.commit()
+
+
+async def get_broadcast(db: AsyncSession, broadcast_id: int) -> Optional[Broadcast]:
+    result = await db.execute(select(Broadcast).where(Broadcast.id == broadcast_id))
+    return result.scalar_one_or_none()
+
+
+async def get_pending_broadcasts(db: AsyncSession) -> list[Broadcast]:
+    result = await db.execute(select(Broadcast).where(Broadcast.status == "pending").order_by(Broadcast.id))
     return result.scalars().all()
 
 
-async def update_order_status(db: AsyncSession, order_id: int, status: str):
-    await db.execute(update(Order).where(Order.id == order_id).values(status=status))
+async def broadcast_progress(db: AsyncSession, broadcast_id: int) -> dict[str, int]:
+    """{статус получателя: количество}"""
+    result = await db.execute(
+        select(BroadcastRecipient.status, func.count())
+        .where(BroadcastRecipient.broadcast_id == broadcast_id)
+        .group_by(BroadcastRecipient.status)
+    )
+    return dict(result.all())
+
+
+async def claim_broadcast_recipients(db: AsyncSession, broadcast_id: int, limit: int) -> list[tuple[int, int]]:
+    """
+    Забирает pending-получателей (→ sending) условным UPDATE — параллельный
+    процесс тех же не получит. Возвращает [(id, telegram_id)].
+    """
+    result = await db.execute(
+        select(BroadcastRecipient.id)
+        .where(BroadcastRecipient.broadcast_id == broadcast_id, BroadcastRecipient.status == "pending")
+        .order_by(BroadcastRecipient.id)
+        .limit(limit)
+    )
+    ids = result.scalars().all()
+    if not ids:
+        return []
+    claimed = await db.execute(
+        update(BroadcastRecipient)
+        .where(BroadcastRecipient.id.in_(ids), BroadcastRecipient.status == "pending")
+        .values(status="sending", claimed_at=datetime.utcnow())
+        .returning(BroadcastRecipient.id, BroadcastRecipient.telegram_id)
+        .execution_options(synchronize_session=False)
+    )
+    rows = [tuple(row) for row in claimed.all()]
+    await db.commit()
+    return sorted(rows)
+
+
+async def finish_broadcast_recipient(db: AsyncSession, recipient_id: int, status: str, error: Optional[str] = None):
+    await db.execute(
+        update(BroadcastRecipient)
+        # Только из sending: строку могли уже закрыть как зависшую
+        .where(BroadcastRecipient.id == recipient_id, BroadcastRecipient.status == "sending")
+        .values(status=status, error=error[:1000] if error else None)
+    )
+    await db.commit()
+
+
+async def release_broadcast_recipient(db: AsyncSession, recipient_id: int):
+    """Вернуть в pending — сообщение точно не ушло (429, остановка)"""
+    await db.execute(
+        update(BroadcastRecipient)
+        .where(BroadcastRecipient.id == recipient_id, BroadcastRecipient.status == "sending")
+        .values(status="pending", claimed_at=None)
+    )
+    await db.commit()
+
+
+async def fail_stale_broadcast_recipients(db: AsyncSession, older_than: timedelta) -> int:
+    """
+    sending дольше older_than — процесс упал посреди отправки. Ушло ли
+    сообщение, неизвестно; повтор мог бы задвоить его, поэтому — failed.
+    """
+    result = await db.execute(
+        update(BroadcastRecipient)
+        .where(BroadcastRecipient.status == "sending", BroadcastRecipient.claimed_at < datetime.utcnow() - older_than)
+        .values(status="failed", error="Отправка прервана перезапуском — доставка не подтверждена")
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def complete_broadcast(db: AsyncSession, broadcast_id: int) -> bool:
+    """Закрыть рассылку, если не осталось pending и sending"""
+    result = await db.execute(
+        update(Broadcast)
+        .where(
+            Broadcast.id == broadcast_id,
+            Broadcast.status == "pending",
+            ~select(BroadcastRecipient.id).where(
+                BroadcastRecipient.broadcast_id == broadcast_id,
+                BroadcastRecipient.status.in_(("pending", "sending")),
+            ).exists(),
+        )
+        .values(status="done", finished_at=datetime.utcnow())
+    )
     await db.commit()
+    return result.rowcount > 0
@@ -0,0 +1,93 @@
+"""
+Настройка движка БД под backend.
+
+SQLite: WAL (читатели не блокируются писателем), synchronous=NORMAL,
+busy_timeout вместо мгновенного «database is locked», mmap и кэш страниц.
+Postgres: пул соединений, параметры задаются переменными окружения.
+"""
+import os
+from typing import Optional
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, "1" if default else "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def normalize_url(url: str) -> str:
+    """postgres:// от Railway → async-драйвер asyncpg"""
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+def _sqlite_settings() -> dict:
+    return {
+        "busy_timeout": _env_int("DB_SQLITE_BUSY_TIMEOUT_MS", 5000),
+        "mmap_size": _env_int("DB_SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+        "cache_size": _env_int("DB_SQLITE_CACHE_SIZE", -20000),   # < 0 — в КиБ
+        "wal": _env_bool("DB_SQLITE_WAL", True),
+    }
+
+
+def _pool_settings() -> dict:
+    return {
+        "pool_size": _env_int("DB_POOL_SIZE", 10),
+        "max_overflow": _env_int("DB_MAX_OVERFLOW", 20),
+        "pool_timeout": _env_int("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": _env_int("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", True),
+    }
+
+
+def _apply_sqlite_pragmas(engine: AsyncEngine, settings: dict, in_memory: bool):
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if settings["wal"] and not in_memory:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={settings['busy_timeout']}")
+        cursor.execute(f"PRAGMA mmap_size={settings['mmap_size']}")
+        cursor.execute(f"PRAGMA cache_size={settings['cache_size']}")
+        cursor.close()
+
+
+def build_engine(database_url: str) -> tuple[AsyncEngine, str]:
+    """Возвращает (engine, описание профиля для лога)"""
+    url = make_url(normalize_url(database_url))
+    if url.get_backend_name() == "sqlite":
+        settings = _sqlite_settings()
+        in_memory = url.database in (None, "", ":memory:")
+        engine = create_async_engine(
+            url, echo=False,
+            connect_args={"timeout": settings["busy_timeout"] / 1000},
+        )
+        _apply_sqlite_pragmas(engine, settings, in_memory)
+        journal = "WAL" if settings["wal"] and not in_memory else "default journal"
+        profile = (f"sqlite ({journal}, busy_timeout={settings['busy_timeout']}ms, "
+                   f"mmap={settings['mmap_size']}, cache_size={settings['cache_size']})")
+        return engine, profile
+
+    pool = _pool_settings()
+    engine = create_async_engine(url, echo=False, **pool)
+    profile = (f"{url.get_backend_name()} pooled (size={pool['pool_size']}, overflow={pool['max_overflow']}, "
+               f"timeout={pool['pool_timeout']}s, recycle={pool['pool_recycle']}s, pre_ping={pool['pool_pre_ping']})")
+    return engine, profile
+
+
+def pool_capacity(database_url: str) -> Optional[int]:
+    """Сколько соединений пул выдаёт одновременно (size + max_overflow); None — без предела (SQLite, overflow -1)"""
+    if make_url(normalize_url(database_url)).get_backend_name() == "sqlite":
+        return None
+    pool = _pool_settings()
+    if pool["max_overflow"] < 0:
+        return None
+    return pool["pool_size"] + pool["max_overflow"]
@@ -0,0 +1,123 @@
+"""
+Согласование кэшей между процессами (uvicorn --workers N).
+
+Кэш регистрирует сброс через subscribe(name, reset). Его invalidate()
+сбрасывает свою копию сразу и вызывает publish(name) — счётчик name в
+таблице cache_versions увеличивается. Сбросы за PUBLISH_DELAY секунд
+копятся и уходят одной транзакцией, а не отдельной записью в горячую
+строку на каждое изменение. Каждый процесс раз в
+CACHE_SYNC_INTERVAL секунд читает счётчики и сбрасывает кэши, версия
+которых выросла, — другие воркеры видят изменение с задержкой не больше
+интервала. Без start() (polling-режим, CLI) publish ничего не делает.
+"""
+import asyncio
+import logging
+import os
+from typing import Callable, Optional
+from sqlalchemy import select, update, insert
+from sqlalchemy.exc import IntegrityError
+from .models import AsyncSessionLocal, CacheVersion
+
+logger = logging.getLogger(__name__)
+
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "2"))   # 0 — выключено
+PUBLISH_DELAY = 0.2
+
+_handlers: dict[str, Callable[[], None]] = {}
+_seen: dict[str, int] = {}
+_task: Optional[asyncio.Task] = None
+_dirty: set[str] = set()
+_flush: Optional[asyncio.Task] = None
+
+
+def subscribe(name: str, reset: Callable[[], None]):
+    _handlers[name] = reset
+
+
+def publish(name: str):
+    """Сообщить остальным процессам об изменении (вызывать после commit)"""
+    global _flush
+    if _task is None:
+        return
+    _dirty.add(name)
+    if _flush is None:
+        _flush = asyncio.create_task(_publish_dirty())
+
+
+async def _publish_dirty():
+    global _flush
+    await asyncio.sleep(PUBLISH_DELAY)
+    names = sorted(_dirty)
+    _dirty.clear()
+    _flush = None           # новые сбросы во время записи уйдут следующей пачкой
+    await _bump(names)
+
+
+async def _bump(names: list[str]):
+    try:
+        versions = {}
+        async with AsyncSessionLocal() as db:
+            for name in names:
+                result = await db.execute(
+                    update(CacheVersion).where(CacheVersion.name == name)
+                    .values(version=CacheVersion.version + 1)
+                    .returning(CacheVersion.version)
+                )
+                version = result.scalar_one_or_none()
+                if version is None:
+                    version = 1
+                    await db.execute(insert(CacheVersion).values(name=name, version=version))
+                versions[name] = version
+            await db.commit()
+    except IntegrityError:      # счётчик только что создал соседний процесс
+        return await _bump(names)
+    except Exception:
+        logger.exception("Не удалось опубликовать сброс кэшей %s", ", ".join(names))
+        return
+    # Свой сброс уже сделан; если между нами вклинился другой процесс — поймаем его при опросе
+    for name, version in versions.items():
+        if version == _seen.get(name, 0) + 1:
+            _seen[name] = version
+
+
+async def _read() -> dict[str, int]:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(CacheVersion.name, CacheVersion.version))
+        return dict(result.all())
+
+
+async def poll():
+    """Сбросить кэши, которые изменил другой процесс"""
+    for name, version in (await _read()).items():
+        if version != _seen.get(name, 0):
+            _seen[name] = version
+            reset = _handlers.get(name)
+            if reset is not None:
+                reset()
+
+
+async def _run():
+    while True:
+        await asyncio.sleep(CACHE_SYNC_INTERVAL)
+        try:
+            await poll()
+        except Exception:
+            logger.exception("Ошибка опроса версий кэшей")
+
+
+async def start():
+    global _task
+    if CACHE_SYNC_INTERVAL <= 0:
+        return
+    _seen.update(await _read())     # кэши при старте пусты — сбрасывать нечего
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    _task = None
+    if _flush is not None:
+        await asyncio.gather(_flush, return_exceptions=True)
@@ -0,0 +1,167 @@
+"""
+Простые миграции схемы поверх create_all.
+
+create_all создаёт только новые таблицы, поэтому изменения существующих
+(индексы, переносы данных) делаются здесь. Номер последней применённой
+миграции хранится в таблице schema_version; если он равен последнему,
+init_db пропускает create_all. Поэтому новая таблица в models.py требует
+новой миграции (хотя бы пустой) — иначе на существующей базе её не создадут.
+"""
+import json
+import logging
+from sqlalchemy import select, insert, update, exists, text, inspect
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
+from .models import Order, OrderItem, Product, SchemaVersion
+
+logger = logging.getLogger(__name__)
+
+
+async def _get_version(conn: AsyncConnection) -> int:
+    result = await conn.execute(select(SchemaVersion.version).where(SchemaVersion.id == 1))
+    return result.scalar_one_or_none() or 0
+
+
+async def _set_version(conn: AsyncConnection, version: int):
+    result = await conn.execute(update(SchemaVersion).where(SchemaVersion.id == 1).values(version=version))
+    if result.rowcount == 0:
+        await conn.execute(insert(SchemaVersion).values(id=1, version=version))
+
+
+# ─── 1: order_items + индексы orders ─────────────────────────
+
+async def _relax_items_json(conn: AsyncConnection):
+    """items_json больше не обязателен — новые заявки пишут позиции в order_items"""
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        await conn.execute(text("ALTER TABLE orders ALTER COLUMN items_json DROP NOT NULL"))
+    elif dialect == "sqlite":
+        # SQLite не умеет снимать NOT NULL — пересоздаём таблицу
+        info = (await conn.execute(text("PRAGMA table_info(orders)"))).mappings().all()
+        if not any(c["name"] == "items_json" and c["notnull"] for c in info):
+            return
+        columns = ", ".join(c["name"] for c in info)
+        await conn.execute(text("ALTER TABLE orders RENAME TO orders_legacy"))
+        await conn.run_sync(Order.__table__.create)
+        await conn.execute(text(f"INSERT INTO orders ({columns}) SELECT {columns} FROM orders_legacy"))
+        await conn.execute(text("DROP TABLE orders_legacy"))
+
+
+async def _create_order_indexes(conn: AsyncConnection):
+    for index in Order.__table__.indexes:
+        await conn.run_sync(lambda sync_conn, index=index: index.create(sync_conn, checkfirst=True))
+
+
+async def _backfill_order_items(conn: AsyncConnection):
+    result = await conn.execute(
+        select(Order.id, Order.items_json).where(
+            Order.items_json.is_not(None),
+            ~exists().where(OrderItem.order_id == Order.id),
+        )
+    )
+    legacy = result.all()
+    if not legacy:
+        return
+    names = dict((await conn.execute(select(Product.id, Product.name))).all())
+    rows = []
+    for order_id, items_json in legacy:
+        for item in json.loads(items_json or "[]"):
+            rows.append({
+                "order_id": order_id,
+                "product_id": item["product_id"],
+                "product_name": names.get(item["product_id"], "?"),
+                "quantity": item["quantity"],
+                "price": item.get("price", 0.0),
+                "line_total": item.get("line_total", 0.0),
+                "unit": item.get("unit", "шт"),
+            })
+    if rows:
+        await conn.execute(insert(OrderItem), rows)
+    logger.info("order_items: перенесено %d позиций из %d заявок", len(rows), len(legacy))
+
+
+async def _migration_1(conn: AsyncConnection):
+    await _relax_items_json(conn)
+    await _create_order_indexes(conn)
+    await _backfill_order_items(conn)
+
+
+# ─── 2: агрегаты продаж по существующим заявкам ──────────────
+
+async def _migration_2(conn: AsyncConnection):
+    from .stats import rebuild
+    await rebuild(conn)
+
+
+# ─── 3: fsm_storage и cache_versions ─────────────────────────
+
+async def _migration_3(conn: AsyncConnection):
+    """Таблицы создаёт create_all — миграция лишь поднимает версию схемы"""
+
+
+# ─── 4: representatives.version ──────────────────────────────
+
+async def _migration_4(conn: AsyncConnection):
+    columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns("representatives"))
+    if not any(c["name"] == "version" for c in columns):
+        await conn.execute(text("ALTER TABLE representatives ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+# ─── 5: broadcasts ───────────────────────────────────────────
+
+async def _migration_5(conn: AsyncConnection):
+    """Таблицы рассылок создаёт create_all — миграция лишь поднимает версию схемы"""
+
+
+# ─── 6: idempotency_keys.payload_hash ────────────────────────
+
+async def _migration_6(conn: AsyncConnection):
+    columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns("idempotency_keys"))
+    if not any(c["name"] == "payload_hash" for c in columns):
+        await conn.execute(text("ALTER TABLE idempotency_keys ADD COLUMN payload_hash VARCHAR(64)"))
+
+
+# ─── 7: processed_updates ────────────────────────────────────
+
+async def _migration_7(conn: AsyncConnection):
+    """Таблицу создаёт create_all — миграция лишь поднимает версию схемы"""
+
+
+# ─── 8: idempotency_keys.owner ───────────────────────────────
+
+async def _migration_8(conn: AsyncConnection):
+    columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns("idempotency_keys"))
+    if not any(c["name"] == "owner" for c in columns):
+        await conn.execute(text("ALTER TABLE idempotency_keys ADD COLUMN owner VARCHAR(32)"))
+
+
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+    (8, _migration_8),
+]
+
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def is_current(conn: AsyncConnection) -> bool:
+    """Схема уже на последней версии (таблицы schema_version может ещё не быть)"""
+    try:
+        return await _get_version(conn) == LATEST_VERSION
+    except DBAPIError:
+        return False
+
+
+async def migrate(conn: AsyncConnection):
+    version = await _get_version(conn)
+    for number, step in MIGRATIONS:
+        if number > version:
+            logger.info("Применяю миграцию схемы %d", number)
+            await step(conn)
+            await _set_version(conn, number)
@@ -1,12 +1,15 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text, BigInteger
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, Boolean, Text, BigInteger, Index
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.exc import DBAPIError
 from datetime import datetime
+import asyncio
 import os
+from .engine import build_engine
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./pharmacy.db")
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+engine, ENGINE_PROFILE = build_engine(DATABASE_URL)
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
@@ -32,10 +35,16 @@ class Representative(Base):
     telegram_id = Column(BigInteger, unique=True, nullable=False)
     full_name = Column(String(255), nullable=False)
     is_active = Column(Boolean, default=True)
+    version = Column(Integer, nullable=False, default=1, server_default="1")   # +1 при изменении — отзывает токены Mini App
 
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_created_at", "created_at"),
+        Index("ix_orders_status_created_at", "status", "created_at"),
+        Index("ix_orders_rep_code_created_at", "rep_code", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True)
     telegram_id = Column(BigInteger, nullable=False)
@@ -43,7 +52,7 @@ class Order(Base):
     rep_code = Column(String(50), nullable=True)             # код медпредставителя
     full_name = Column(String(255), nullable=False)
     institution = Column(String(500), nullable=False)
-    items_json = Column(Text, nullable=False)
+    items_json = Column(Text, nullable=True)                 # устарело: позиции теперь в order_items
     total_items = Column(Integer, default=0)
     total_price = Column(Float, default=0.0)                 # полная сумма
     payment_percent = Column(Integer, default=100)           # 50 или 100
@@ -52,10 +61,166 @@ class Order(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     sheets_row = Column(Integer, nullable=True)
 
+    items = relationship(
+        "OrderItem",
+        primaryjoin="Order.id == foreign(OrderItem.order_id)",
+        order_by="OrderItem.id",
+        cascade="all, delete-orphan",
+    )
 
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+
+class OrderItem(Base):
+    __tablename__ = "order_items"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, nullable=False, index=True)
+    product_id = Column(Integer, nullable=False, index=True)
+    product_name = Column(String(255), nullable=False)       # название на момент заявки
+    quantity = Column(Integer, nullable=False)
+    price = Column(Float, default=0.0)
+    line_total = Column(Float, default=0.0)
+    unit = Column(String(50), default="шт")
+
+
+# ─── Агрегаты продаж (обновляются вместе с заявками, см. db/stats.py) ───
+
+class SalesDailyRep(Base):
+    __tablename__ = "sales_daily_rep"
+
+    day = Column(Date, primary_key=True)
+    rep_code = Column(String(50), primary_key=True)
+    orders_count = Column(Integer, default=0)
+    items_count = Column(Integer, default=0)
+    total_price = Column(Float, default=0.0)
+    payment_amount = Column(Float, default=0.0)
+
+
+class SalesDailyInstitution(Base):
+    __tablename__ = "sales_daily_institution"
+
+    day = Column(Date, primary_key=True)
+    institution = Column(String(500), primary_key=True)
+    orders_count = Column(Integer, default=0)
+    items_count = Column(Integer, default=0)
+    total_price = Column(Float, default=0.0)
+    payment_amount = Column(Float, default=0.0)
+
+
+class SalesDailyProduct(Base):
+    __tablename__ = "sales_daily_product"
+
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    product_name = Column(String(255), nullable=False)
+    orders_count = Column(Integer, default=0)
+    quantity = Column(Integer, default=0)
+    line_total = Column(Float, default=0.0)
+
+
+class IdempotencyKey(Base):
+    """Ответ на заявку, сохранённый по ключу идемпотентности — для повторов с плохой связью"""
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(128), primary_key=True)               # "<telegram_id>:<ключ клиента>"
+    status = Column(String(20), default="pending")            # pending / done
+    payload_hash = Column(String(64), nullable=True)          # sha256 тела заявки — ключ не переносится на другую корзину
+    owner = Column(String(32), nullable=True)                 # токен запроса, держащего аренду pending-ключа
+    response_json = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+class SheetOutbox(Base):
+    """Очередь строк для выгрузки в Google Sheets (пишется в одной транзакции с заказом)"""
+    __tablename__ = "sheets_outbox"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, nullable=False)
+    row_json = Column(Text, nullable=False)                  # готовая строка таблицы
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class FsmRecord(Base):
+    """Состояние и данные FSM aiogram — общие для всех воркеров (bot/storage.py)"""
+    __tablename__ = "fsm_storage"
+
+    key = Column(String(255), primary_key=True)      # bot:chat:user:thread:destiny
+    state = Column(String(255), nullable=True)
+    data_json = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class CacheVersion(Base):
+    """Счётчики версий кэшей: рост — сигнал другим процессам сбросить кэш (db/invalidation.py)"""
+    __tablename__ = "cache_versions"
+
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class ProcessedUpdate(Base):
+    """update_id, принятые webhook'ом любым воркером — повторная доставка не обрабатывается дважды"""
+    __tablename__ = "processed_updates"
+
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class Broadcast(Base):
+    """Рассылка всем представителям; выполняет bot/broadcast.py, переживает рестарт"""
+    __tablename__ = "broadcasts"
+
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    status = Column(String(20), default="pending", index=True)   # pending / done
+    created_by = Column(BigInteger, nullable=True)
+    progress_chat_id = Column(BigInteger, nullable=True)         # сообщение с прогрессом в боте
+    progress_message_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class BroadcastRecipient(Base):
+    """Получатель рассылки: pending → sending → sent / failed"""
+    __tablename__ = "broadcast_recipients"
+    __table_args__ = (
+        Index("ix_broadcast_recipients_broadcast_status", "broadcast_id", "status"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    broadcast_id = Column(Integer, nullable=False)
+    telegram_id = Column(BigInteger, nullable=False)
+    status = Column(String(20), default="pending")
+    claimed_at = Column(DateTime, nullable=True)
+    error = Column(Text, nullable=True)
+
+
+async def init_db() -> bool:
+    """Создать таблицы и применить миграции; False — схема уже актуальна, ничего не делали"""
+    from .migrations import is_current, migrate
+    for attempt in range(5):
+        async with engine.connect() as conn:
+            if await is_current(conn):
+                return False
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await migrate(conn)
+            return True
+        except DBAPIError:
+            # Несколько воркеров стартуют разом — схему мог обновлять соседний процесс
+            if attempt == 4:
+                raise
+            await asyncio.sleep(1)
 
 
 async def get_db():
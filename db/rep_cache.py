@@ -0,0 +1,120 @@
+"""
+Кэш медпредставителей (TTL + LRU).
+
+check-rep вызывается при каждом открытии Mini App, а таблица
+representatives меняется только из админки — поэтому держим записи
+в памяти и сбрасываем кэш целиком при любом изменении представителей
+(во всех воркерах — через db/invalidation.py).
+"""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import crud, invalidation
+
+TTL = float(os.getenv("REP_CACHE_TTL", "300"))
+MAX_SIZE = int(os.getenv("REP_CACHE_SIZE", "10000"))
+
+
+@dataclass(frozen=True)
+class RepInfo:
+    """Отвязанная от сессии копия Representative"""
+    id: int
+    code: str
+    telegram_id: int
+    full_name: str
+    is_active: bool
+    version: int = 1
+
+
+_entries: "OrderedDict[tuple, tuple[float, Optional[RepInfo]]]" = OrderedDict()
+_hits = 0
+_misses = 0
+_versions: Optional[dict[int, int]] = None     # id → version всех представителей
+_generation = 0
+
+
+def _get(key: tuple):
+    global _hits, _misses
+    entry = _entries.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        _misses += 1
+        return False, None
+    _entries.move_to_end(key)
+    _hits += 1
+    return True, entry[1]
+
+
+def _put(key: tuple, rep: Optional[RepInfo]):
+    _entries[key] = (time.monotonic() + TTL, rep)
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_SIZE:
+        _entries.popitem(last=False)
+
+
+def _store(key: tuple, rep, generation: int) -> Optional[RepInfo]:
+    info = None
+    if rep is not None:
+        info = RepInfo(rep.id, rep.code, rep.telegram_id, rep.full_name, rep.is_active, rep.version)
+    # Сброс во время чтения — запись могла устареть, не кэшируем
+    if generation != _generation:
+        return info
+    if info is not None:
+        _put(("tg", info.telegram_id), info)
+        _put(("code", info.code), info)
+    _put(key, info)
+    return info
+
+
+async def get_by_telegram_id(db: AsyncSession, telegram_id: int) -> Optional[RepInfo]:
+    found, rep = _get(("tg", telegram_id))
+    if found:
+        return rep
+    generation = _generation
+    return _store(("tg", telegram_id), await crud.get_rep_by_telegram_id(db, telegram_id), generation)
+
+
+async def get_by_code(db: AsyncSession, code: str) -> Optional[RepInfo]:
+    found, rep = _get(("code", code))
+    if found:
+        return rep
+    generation = _generation
+    return _store(("code", code), await crud.get_rep_by_code(db, code), generation)
+
+
+async def is_current(db: AsyncSession, rep_id: int, version: int) -> bool:
+    """
+    Версия представителя не менялась — токен Mini App действителен.
+    Таблица версий читается одним запросом и живёт до invalidate().
+    """
+    global _versions
+    versions = _versions
+    if versions is None:
+        generation = _generation
+        versions = await crud.get_rep_versions(db)
+        # Сброс во время чтения — не кэшируем, следующий вызов перечитает
+        if generation == _generation:
+            _versions = versions
+    return versions.get(rep_id) == version
+
+
+def _reset():
+    global _versions, _generation
+    _entries.clear()
+    _versions = None
+    _generation += 1
+
+
+def invalidate():
+    """Вызывать после любого изменения представителей (после commit)"""
+    _reset()
+    invalidation.publish("reps")
+
+
+invalidation.subscribe("reps", _reset)
+
+
+def stats() -> dict:
+    return {"hits": _hits, "misses": _misses, "size": len(_entries)}
@@ -0,0 +1,158 @@
+"""
+Поиск по каталогу в памяти: префиксы + триграммы (опечатки).
+
+Индекс строится по снимку каталога (db/catalog.py) и при смене версии
+обновляется инкрементально — переиндексируются только изменившиеся
+препараты. Регистр и «ё» нормализуются (casefold), так что «АМОКС»,
+«амокс» и «амоксицилин» находят «Амоксициллин».
+"""
+import asyncio
+import re
+from bisect import bisect_left
+from typing import Optional
+from . import catalog
+
+NAME_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.0
+PREFIX_SCORE = 1.0
+EXACT_BONUS = 0.2
+FUZZY_THRESHOLD = 0.35       # минимальное сходство по триграммам (Жаккар)
+FUZZY_FACTOR = 0.8
+
+_TOKEN = re.compile(r"[^\W\d_]+|\d+")      # «500мг» → «500», «мг»
+
+
+def normalize(text: str) -> list[str]:
+    return _TOKEN.findall((text or "").casefold().replace("ё", "е"))
+
+
+def trigrams(token: str) -> set[str]:
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    def __init__(self):
+        self.version: Optional[int] = None
+        self._docs: dict[int, tuple] = {}                  # id → (name, description) — что проиндексировано
+        self._items: dict[int, dict] = {}                  # id → словарь из каталога
+        self._postings: dict[str, dict[int, float]] = {}   # токен → {id: вес поля}
+        self._grams: dict[str, set[str]] = {}              # триграмма → токены
+        self._vocabulary: list[str] = []
+        self._vocabulary_dirty = False
+
+    # ─── обновление ──────────────────────────────────────────
+
+    def _add(self, product_id: int, name: str, description: str):
+        fields = {}
+        for token in normalize(description):
+            fields[token] = DESCRIPTION_WEIGHT
+        for token in normalize(name):
+            fields[token] = NAME_WEIGHT
+        for token, weight in fields.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                for gram in trigrams(token):
+                    self._grams.setdefault(gram, set()).add(token)
+                self._vocabulary_dirty = True
+            postings[product_id] = weight
+        self._docs[product_id] = (name, description)
+
+    def _remove(self, product_id: int):
+        name, description = self._docs.pop(product_id)
+        for token in set(normalize(name)) | set(normalize(description)):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[token]
+                for gram in trigrams(token):
+                    tokens = self._grams.get(gram)
+                    if tokens is not None:
+                        tokens.discard(token)
+                        if not tokens:
+                            del self._grams[gram]
+                self._vocabulary_dirty = True
+
+    def sync(self, version: int, items) -> int:
+        """Привести индекс к снимку каталога. Возвращает число переиндексированных."""
+        changed = 0
+        fresh = {item["id"]: item for item in items}
+        for product_id in list(self._docs):
+            if product_id not in fresh:
+                self._remove(product_id)
+                changed += 1
+        for product_id, item in fresh.items():
+            doc = (item["name"], item["description"] or "")
+            if self._docs.get(product_id) != doc:
+                if product_id in self._docs:
+                    self._remove(product_id)
+                self._add(product_id, *doc)
+                changed += 1
+        self._items = fresh
+        self.version = version
+        return changed
+
+    # ─── поиск ───────────────────────────────────────────────
+
+    def _matches(self, query_token: str) -> dict[str, float]:
+        """Токены словаря, подходящие под слово запроса, и их балл"""
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        matches: dict[str, float] = {}
+        start = bisect_left(self._vocabulary, query_token)
+        for token in self._vocabulary[start:]:
+            if not token.startswith(query_token):
+                break
+            matches[token] = PREFIX_SCORE + (EXACT_BONUS if token == query_token else 0.0)
+        if len(query_token) >= 3:
+            query_grams = trigrams(query_token)
+            shared: dict[str, int] = {}
+            for gram in query_grams:
+                for token in self._grams.get(gram, ()):
+                    shared[token] = shared.get(token, 0) + 1
+            for token, common in shared.items():
+                if token in matches:
+                    continue
+                similarity = common / (len(query_grams) + len(trigrams(token)) - common)
+                if similarity >= FUZZY_THRESHOLD:
+                    matches[token] = similarity * FUZZY_FACTOR
+        return matches
+
+    def search(self, query: str) -> list[dict]:
+        """Все подходящие препараты по убыванию релевантности (каждое слово запроса должно найтись)"""
+        query_tokens = list(dict.fromkeys(normalize(query)))
+        if not query_tokens:
+            return []
+        scores: Optional[dict[int, float]] = None
+        for query_token in query_tokens:
+            token_scores: dict[int, float] = {}
+            for token, score in self._matches(query_token).items():
+                for product_id, weight in self._postings[token].items():
+                    value = score * weight
+                    if value > token_scores.get(product_id, 0.0):
+                        token_scores[product_id] = value
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {pid: scores[pid] + value for pid, value in token_scores.items() if pid in scores}
+            if not scores:
+                return []
+        ranked = sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))
+        return [{**self._items[pid], "score": round(score, 3)} for pid, score in ranked]
+
+
+_index = SearchIndex()
+_lock = asyncio.Lock()
+
+
+async def search(query: str) -> list[dict]:
+    snapshot = await catalog.get_snapshot()
+    if _index.version != snapshot.version:
+        async with _lock:
+            if _index.version != snapshot.version:
+                _index.sync(snapshot.version, snapshot.items)
+    return _index.search(query)
@@ -0,0 +1,187 @@
+"""
+Агрегаты продаж по дням: × представитель, × учреждение, × препарат.
+
+Обновляются в той же транзакции, что и заявка (crud.create_order и
+crud.bulk_update_order_status — отмена вычитает вклад заявки), поэтому
+сводка читается из небольших таблиц без разбора всех заказов.
+
+Пересчёт с нуля по сырым заявкам:
+    python -m db.stats rebuild
+"""
+import asyncio
+import sys
+from datetime import date
+from typing import Optional
+from sqlalchemy import select, insert, delete, func, cast, Date, distinct
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()       # до импорта моделей — там читается DATABASE_URL
+
+from .models import (
+    AsyncSessionLocal, Order, OrderItem,
+    SalesDailyRep, SalesDailyInstitution, SalesDailyProduct,
+)
+
+GROUPS = {
+    "day": (SalesDailyRep, "day"),
+    "rep": (SalesDailyRep, "rep_code"),
+    "institution": (SalesDailyInstitution, "institution"),
+    "product": (SalesDailyProduct, "product_id"),
+}
+
+
+def _dialect(db) -> str:
+    bind = getattr(db, "bind", None) or db
+    return bind.dialect.name
+
+
+def _day(db, column):
+    # В SQLite CAST(... AS DATE) даёт число — берём date()
+    return func.date(column) if _dialect(db) == "sqlite" else cast(column, Date)
+
+
+async def _add(db, model, keys: tuple, rows: list[dict]):
+    """INSERT ... ON CONFLICT DO UPDATE SET col = col + excluded.col"""
+    if not rows:
+        return
+    if _dialect(db) == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    table = model.__table__
+    stmt = dialect_insert(table)
+    set_ = {}
+    for column in rows[0]:
+        if column in keys:
+            continue
+        if column == "product_name":
+            set_[column] = stmt.excluded[column]
+        else:
+            set_[column] = table.c[column] + stmt.excluded[column]
+    await db.execute(stmt.on_conflict_do_update(index_elements=list(keys), set_=set_), rows)
+
+
+async def _apply(db, orders: list[Order], sign: int):
+    """Вклад заявок суммируется в памяти — по одному upsert на таблицу"""
+    reps: dict[tuple, dict] = {}
+    institutions: dict[tuple, dict] = {}
+    products: dict[tuple, dict] = {}
+    for order in orders:
+        day = order.created_at.date()
+        totals = {
+            "orders_count": sign,
+            "items_count": sign * (order.total_items or 0),
+            "total_price": sign * (order.total_price or 0.0),
+            "payment_amount": sign * (order.payment_amount or 0.0),
+        }
+        for rows, key, value in ((reps, "rep_code", order.rep_code or ""),
+                                 (institutions, "institution", order.institution)):
+            row = rows.setdefault((day, value), {"day": day, key: value, **dict.fromkeys(totals, 0)})
+            for column, amount in totals.items():
+                row[column] += amount
+
+        seen = set()
+        for item in order.items:
+            row = products.setdefault((day, item.product_id), {
+                "day": day, "product_id": item.product_id, "product_name": item.product_name,
+                "orders_count": 0, "quantity": 0, "line_total": 0.0,
+            })
+            if item.product_id not in seen:
+                seen.add(item.product_id)
+                row["orders_count"] += sign
+            row["quantity"] += sign * item.quantity
+            row["line_total"] += sign * (item.line_total or 0.0)
+
+    await _add(db, SalesDailyRep, ("day", "rep_code"), list(reps.values()))
+    await _add(db, SalesDailyInstitution, ("day", "institution"), list(institutions.values()))
+    await _add(db, SalesDailyProduct, ("day", "product_id"), list(products.values()))
+
+
+async def record_order(db, order: Order):
+    """Учесть заявку (order.items должны быть загружены). Без commit."""
+    await _apply(db, [order], 1)
+
+
+async def revert_orders(db, orders: list[Order]):
+    """Вычесть вклад нескольких заявок разом — массовая отмена. Без commit."""
+    await _apply(db, orders, -1)
+
+
+async def summary(db, group_by: str, date_from: Optional[date] = None, date_to: Optional[date] = None) -> list[dict]:
+    model, key = GROUPS[group_by]
+    key_column = getattr(model, key)
+    if model is SalesDailyProduct:
+        measures = [
+            func.max(model.product_name).label("product_name"),
+            func.sum(model.orders_count).label("orders"),
+            func.sum(model.quantity).label("quantity"),
+            func.sum(model.line_total).label("total_price"),
+        ]
+    else:
+        measures = [
+            func.sum(model.orders_count).label("orders"),
+            func.sum(model.items_count).label("items"),
+            func.sum(model.total_price).label("total_price"),
+            func.sum(model.payment_amount).label("payment_amount"),
+        ]
+    query = select(key_column.label(key), *measures).group_by(key_column)
+    if date_from:
+        query = query.where(model.day >= date_from)
+    if date_to:
+        query = query.where(model.day <= date_to)
+    if group_by == "day":
+        query = query.order_by(key_column)
+    else:
+        money = model.line_total if model is SalesDailyProduct else model.total_price
+        query = query.order_by(func.sum(money).desc())
+    result = await db.execute(query)
+    rows = []
+    for row in result.mappings().all():
+        row = dict(row)
+        if isinstance(row.get("day"), date):
+            row["day"] = row["day"].isoformat()
+        for money in ("total_price", "payment_amount"):
+            if money in row and row[money] is not None:
+                row[money] = round(row[money], 2)
+        rows.append(row)
+    return rows
+
+
+async def rebuild(db):
+    """Пересчитать все агрегаты по сырым заявкам (отменённые не учитываются). Без commit."""
+    for model in (SalesDailyRep, SalesDailyInstitution, SalesDailyProduct):
+        await db.execute(delete(model))
+    day = _day(db, Order.created_at)
+    active = Order.status != "cancelled"
+    rep_code = func.coalesce(Order.rep_code, "")
+
+    for model, key, key_expr in ((SalesDailyRep, "rep_code", rep_code),
+                                 (SalesDailyInstitution, "institution", Order.institution)):
+        await db.execute(insert(model).from_select(
+            ["day", key, "orders_count", "items_count", "total_price", "payment_amount"],
+            select(day, key_expr, func.count(Order.id), func.sum(Order.total_items),
+                   func.sum(Order.total_price), func.sum(Order.payment_amount))
+            .where(active).group_by(day, key_expr),
+        ))
+
+    await db.execute(insert(SalesDailyProduct).from_select(
+        ["day", "product_id", "product_name", "orders_count", "quantity", "line_total"],
+        select(day, OrderItem.product_id, func.max(OrderItem.product_name), func.count(distinct(Order.id)),
+               func.sum(OrderItem.quantity), func.sum(OrderItem.line_total))
+        .select_from(Order).join(OrderItem, OrderItem.order_id == Order.id)
+        .where(active).group_by(day, OrderItem.product_id),
+    ))
+
+
+async def _rebuild_cli():
+    async with AsyncSessionLocal() as db:
+        await rebuild(db)
+        await db.commit()
+    print("Агрегаты продаж пересчитаны")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("Использование: python -m db.stats rebuild")
+    asyncio.run(_rebuild_cli())
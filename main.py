@@ -1,50 +1,147 @@
 """
 Единая точка входа: FastAPI + Telegram Bot (webhook)
 """
+import time
+
+_BOOT_STARTED = time.perf_counter()
+
 import asyncio
+import hashlib
+import hmac
 import os
 import logging
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from fastapi import FastAPI, Request
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from db.models import init_db
+from db.models import init_db, engine, ENGINE_PROFILE, DATABASE_URL
+from db.engine import pool_capacity
+from db import rep_cache, invalidation
 from api.routes.products import router as products_router
 from api.routes.orders import router as orders_router
 from api.routes.admin import router as admin_router
+from api.routes.auth import router as auth_router
+from api import sheets_worker, metrics, ratelimit
+from api.static import PrecompressedStatic, CompressionMiddleware
 from bot.main import bot, dp, setup_bot, process_update
+from bot import update_queue as uq, notifier, broadcast
 
 logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+
+
+async def handle_update(data: dict):
+    started = time.perf_counter()
+    result = "error"
+    try:
+        await process_update(data)
+        result = "ok"
+    finally:
+        metrics.WEBHOOK_UPDATE.observe(time.perf_counter() - started, result)
+
+
+update_queue = uq.from_env(handle_update)
+
+metrics.instrument_engine(engine)
+metrics.register(metrics.Gauge("webhook_queue_depth", "Update'ов в очереди", lambda: update_queue.stats()["queue_depth"]))
+metrics.register(metrics.Gauge("webhook_duplicates", "Отброшено повторных update_id", lambda: update_queue.duplicates))
+metrics.register(metrics.Gauge("webhook_rejected", "Update'ов отклонено при полной очереди", lambda: update_queue.rejected))
+metrics.register(metrics.Gauge("rep_cache_hits", "Попадания в кэш представителей", lambda: rep_cache.stats()["hits"]))
+metrics.register(metrics.Gauge("rep_cache_misses", "Промахи кэша представителей", lambda: rep_cache.stats()["misses"]))
+metrics.register(metrics.Gauge("notify_pending", "Уведомлений в очереди", notifier.pending))
+metrics.register(metrics.Gauge("event_loop_lag_seconds", "Задержка event loop", ratelimit.loop_lag))
+
+
+def webhook_url() -> str:
+    """
+    URL webhook'а. Telegram не возвращает secret_token в getWebhookInfo,
+    поэтому отпечаток секрета добавлен в URL — смена секрета меняет URL
+    и webhook переустанавливается.
+    """
+    url = f"{WEBAPP_URL}/webhook"
+    if WEBHOOK_SECRET:
+        url += "?s=" + hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()[:12]
+    return url
+
+
+async def ensure_webhook():
+    url = webhook_url()
+    info = await bot.get_webhook_info()
+    if info.url == url:
+        logger.info(f"Webhook уже установлен: {url}")
+        return
+    await bot.set_webhook(url, secret_token=WEBHOOK_SECRET or None)
+    logger.info(f"Webhook установлен: {url}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Инициализация БД
-    await init_db()
+    phases = [("imports", time.perf_counter() - _BOOT_STARTED)]
+    ratelimit.start()
+
+    @contextmanager
+    def phase(name: str):
+        started = time.perf_counter()
+        yield
+        phases.append((name, time.perf_counter() - started))
+
+    # Инициализация БД: create_all и миграции только если версия схемы устарела
+    logger.info(f"БД: {ENGINE_PROFILE}")
+    with phase("db"):
+        if not await init_db():
+            logger.info("Схема БД актуальна")
+
+    # Сброс кэшей по сигналам других воркеров
+    with phase("cache sync"):
+        await invalidation.start()
+
+    # Фоновая выгрузка в Google Sheets
+    with phase("sheets"):
+        sheets_worker.start()
     
     # Настройка бота
-    await setup_bot()
+    with phase("bot"):
+        await setup_bot()
+        await update_queue.start()
+        notifier.start(bot)
+        broadcast.start(bot)
     
     # Установка webhook
     if WEBAPP_URL:
-        webhook_url = f"{WEBAPP_URL}/webhook"
-        await bot.set_webhook(webhook_url)
-        logger.info(f"Webhook установлен: {webhook_url}")
+        with phase("webhook"):
+            await ensure_webhook()
+
+    logger.info(
+        "Старт за %.0f ms: %s",
+        sum(elapsed for _, elapsed in phases) * 1000,
+        ", ".join(f"{name} {elapsed * 1000:.0f}" for name, elapsed in phases),
+    )
     
     yield
     
-    await bot.delete_webhook()
+    # webhook не снимаем: при перезапуске или нескольких репликах
+    # его продолжает обслуживать новый процесс
+    await update_queue.stop()
+    await broadcast.stop()
+    await notifier.stop()
+    await sheets_worker.stop()
+    await invalidation.stop()
+    await ratelimit.stop()
     await bot.session.close()
 
 
 app = FastAPI(title="Pharmacy Bot", lifespan=lifespan)
 
+app.add_middleware(ratelimit.LoadShedMiddleware, engine=engine, pool_capacity=pool_capacity(DATABASE_URL))
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -53,24 +150,35 @@ app.add_middleware(
 )
 
 # API роуты
+app.include_router(auth_router)
 app.include_router(products_router)
 app.include_router(orders_router)
 app.include_router(admin_router)
 
 
-# Webhook endpoint для Telegram
+# Webhook endpoint для Telegram: отвечаем сразу, обработка — в очереди
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
+    if WEBHOOK_SECRET:
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            raise HTTPException(401, "Unauthorized")
     data = await request.json()
-    await process_update(data)
+    if await update_queue.submit(data) == uq.REJECTED:
+        return JSONResponse({"ok": False}, status_code=503, headers={"Retry-After": "5"})
     return {"ok": True}
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {"status": "ok", "webhook": update_queue.stats()}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
-# Фронтенд Mini App
+# Фронтенд Mini App: файлы сжимаются один раз при старте
 if os.path.exists("frontend"):
-    app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
+    app.mount("/", PrecompressedStatic("frontend"), name="frontend")
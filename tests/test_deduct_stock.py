@@ -0,0 +1,82 @@
+"""
+Оформление заявок под конкуренцией: 100+ представителей одновременно
+заказывают один препарат с ограниченным остатком. Остаток не уходит в
+минус, списано ровно принятые заявки × количество, а каждая отклонённая
+получает 409 и не оставляет строк в orders / order_items.
+
+    python -m pytest tests/test_deduct_stock.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from db.engine import build_engine
+from db.models import Base, Product, Order, OrderItem
+from db.rep_cache import RepInfo
+from api.routes.orders import OrderCreate, place_order
+
+PRODUCT_ID = 1
+INITIAL_STOCK = 100
+QUANTITY = 3
+REPS = 120          # спрос 360 при остатке 100 — большинство должно получить отказ
+
+
+async def _submit(Session, rep: RepInfo) -> int:
+    payload = OrderCreate(
+        telegram_id=rep.telegram_id,
+        institution=f"Аптека №{rep.id}",
+        items=[{"product_id": PRODUCT_ID, "quantity": QUANTITY}],
+    )
+    async with Session() as db:
+        try:
+            await place_order(payload, db, rep=rep)
+        except HTTPException as e:
+            return e.status_code
+        return 200
+
+
+async def _run(path: str):
+    engine, _ = build_engine(f"sqlite+aiosqlite:///{path}")
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with Session() as db:
+        db.add(Product(id=PRODUCT_ID, name="Амоксициллин", stock=INITIAL_STOCK, price=10.0))
+        await db.commit()
+
+    reps = [RepInfo(i, str(i), 1000 + i, f"Представитель {i}", True) for i in range(1, REPS + 1)]
+    statuses = await asyncio.gather(*(_submit(Session, rep) for rep in reps))
+
+    async with Session() as db:
+        stock = (await db.execute(select(Product.stock).where(Product.id == PRODUCT_ID))).scalar_one()
+        orders = dict((await db.execute(select(Order.id, Order.telegram_id))).all())
+        items = (await db.execute(
+            select(func.count(), func.coalesce(func.sum(OrderItem.quantity), 0))
+        )).one()
+    await engine.dispose()
+    return reps, statuses, stock, orders, items
+
+
+def test_concurrent_orders_do_not_oversell(monkeypatch):
+    monkeypatch.delenv("GOOGLE_SHEET_ID", raising=False)     # без выгрузки в Sheets
+    with tempfile.TemporaryDirectory() as tmp:
+        reps, statuses, stock, orders, (item_rows, item_quantity) = asyncio.run(_run(os.path.join(tmp, "stock.db")))
+
+    accepted = [rep.telegram_id for rep, status in zip(reps, statuses) if status == 200]
+    rejected = [status for status in statuses if status != 200]
+
+    assert stock >= 0
+    assert len(accepted) * QUANTITY == INITIAL_STOCK - stock
+    assert stock < QUANTITY                 # спрос больше остатка — продано всё, что можно
+    assert rejected and set(rejected) == {409}
+    # У отклонённых не осталось ни заявки, ни позиций
+    assert sorted(orders.values()) == sorted(accepted)
+    assert item_rows == len(accepted)
+    assert item_quantity == len(accepted) * QUANTITY